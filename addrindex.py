@@ -0,0 +1,297 @@
+import hashlib
+import json
+import os
+import numpy as np
+from common import AddressCodec
+from ingest import registeredKeys
+
+MAGIC = b'VRIDX001'
+UNIVERSE_MAGIC = b'VRUIX001'
+
+
+def digest(path, blocksize=1 << 20):
+    '''
+    digest() computes the SHA-1 checksum of the file at the given path
+    '''
+    sha = hashlib.sha1()
+    with open(path, 'rb') as istrm:
+        for block in iter(lambda: istrm.read(blocksize), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def fingerprint(path):
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha1': digest(path)}
+
+
+def changed(source, path) -> bool:
+    '''
+    whether the file at the given path differs from the one `source`, as
+    returned by `fingerprint()`, describes
+    '''
+    if source is None:
+        return True
+    stat = os.stat(path)
+    if stat.st_size != source['size']:
+        return True
+    if stat.st_mtime == source['mtime']:
+        return False
+    return digest(path) != source['sha1']
+
+
+def dump(path, magic, header, arrays):
+    '''
+    write a JSON header and int64 arrays of equal length to the given path,
+    laid out as
+
+        magic | header length (uint64) | JSON header | padding | arrays
+
+    so that the arrays can be memory-mapped straight from disk
+    '''
+    header = json.dumps(header).encode('utf-8')
+    offset = len(magic) + 8 + len(header)
+    header += b' ' * (-offset % 8)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as ostrm:
+        ostrm.write(magic)
+        ostrm.write(np.uint64(len(header)).tobytes())
+        ostrm.write(header)
+        for array in arrays:
+            ostrm.write(np.ascontiguousarray(array, dtype='<i8').tobytes())
+    os.replace(tmp, path)
+
+
+def mapped(path, magic, narrays=1):
+    '''
+    read back the header and memory-map the arrays of a file written by
+    `dump()`; the header must give their length as 'count'
+    '''
+    with open(path, 'rb') as istrm:
+        if istrm.read(len(magic)) != magic:
+            raise ValueError(f'{path}: not an index of the expected kind')
+        length = int(np.frombuffer(istrm.read(8), dtype=np.uint64)[0])
+        header = json.loads(istrm.read(length))
+    offset = len(magic) + 8 + length
+    count = header['count']
+    if count == 0:
+        return header, [np.empty(0, dtype=np.int64)] * narrays
+    arrays = np.memmap(path, dtype='<i8', mode='r', offset=offset,
+                       shape=(narrays, count))
+    return header, list(arrays)
+
+
+class RegisteredIndex(object):
+    '''
+    sorted array of the int64 keys of all registered addresses, along with
+    the `AddressCodec` string tables needed to encode other addresses against
+    it. Saved indices are laid out as
+
+        MAGIC | header length (uint64) | JSON header | padding | keys
+
+    so that the key array can be memory-mapped straight from disk.
+    '''
+    def __init__(self, codec: AddressCodec, keys: np.ndarray, source=None):
+        self.codec = codec
+        self.keys = keys
+        self.source = source
+
+    @classmethod
+    def build(cls, addrs, codec=None, source=None):
+        '''
+        build an index from an iterable of `StreetAddress`es
+        '''
+        if codec is None:
+            codec = AddressCodec()
+        return cls(codec, np.unique(codec.encode(addrs)), source)
+
+    @classmethod
+    def fromcsv(cls, path):
+        '''
+        build an index from a BoE registration file, which may be compressed
+        '''
+        codec = AddressCodec()
+        keys = np.unique(registeredKeys(path, codec))
+        return cls(codec, keys, fingerprint(path))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def contains(self, keys: np.ndarray) -> np.ndarray:
+        '''
+        boolean mask of the given keys that belong to a registered address
+        '''
+        keys = np.asarray(keys, dtype=np.int64)
+        if len(self.keys) == 0:
+            return np.zeros(len(keys), dtype=bool)
+        idx = np.searchsorted(self.keys, keys)
+        idx[idx == len(self.keys)] = 0
+        return self.keys[idx] == keys
+
+    def recoded(self, codec: AddressCodec) -> np.ndarray:
+        '''
+        the sorted keys of the index, encoded with another codec instead,
+        leaving out those of addresses it has no id for some part of, which
+        nothing it encoded can match
+        '''
+        def table(old, new):
+            return np.array([new.get(k, -1) for k in old] + [-1],
+                            dtype=np.int64)
+        keys = np.asarray(self.keys, dtype=np.int64)
+        city = table(self.codec.cities, codec.cities)[
+            keys >> codec.CITY_SHIFT]
+        street = table(self.codec.streets, codec.streets)[
+            (keys >> codec.STREET_SHIFT)
+            & ((1 << (codec.CITY_SHIFT - codec.STREET_SHIFT)) - 1)]
+        number = keys & ((1 << codec.STREET_SHIFT) - 1)
+        # house numbers not in canonical form have ids of their own
+        split = number >= codec.NUMBER_SPLIT
+        ids = table(self.codec.numbers, codec.numbers)[
+            number[split] - codec.NUMBER_SPLIT]
+        number[split] = np.where(ids < 0, -1, ids + codec.NUMBER_SPLIT)
+        ok = (city >= 0) & (street >= 0) & (number >= 0)
+        return np.unique(codec.pack(city[ok], street[ok], number[ok]))
+
+    def numbers(self, city: int, street: int, lo: int, hi: int):
+        '''
+        doubled house numbers in [lo, hi] registered on the given street;
+        since keys sort by city, then street, then number, this is a single
+        contiguous slice of the key array
+        '''
+        prefix = self.codec.pack(city, street, 0)
+        i = np.searchsorted(self.keys, prefix + lo, side='left')
+        j = np.searchsorted(self.keys, prefix + hi, side='right')
+        return self.keys[i:j] - prefix
+
+    def stale(self, path) -> bool:
+        '''
+        whether the index was built from something other than the current
+        contents of the file at the given path
+        '''
+        return changed(self.source, path)
+
+    def save(self, path):
+        dump(path, MAGIC, {
+            'count': len(self.keys),
+            'source': self.source,
+            'cities': list(self.codec.cities),
+            'streets': list(self.codec.streets),
+            'numbers': list(self.codec.numbers),
+        }, [self.keys])
+
+    @classmethod
+    def load(cls, path):
+        header, (keys,) = mapped(path, MAGIC)
+        codec = AddressCodec(header['cities'], header['streets'],
+                             header['numbers'])
+        return cls(codec, keys, header['source'])
+
+
+class UniverseIndex(object):
+    '''
+    the int64 key of every record `exclusion()` tests against the registered
+    set, in the order it tests them, given the same `unrollp` and
+    `unroll_max`; along with where each record comes from in the parcel
+    roll: the byte offset of its row, and its position among the records
+    unrolled from that row. Records can be found by key through `order`, a
+    stable argsort of the keys. Saved to disk like `RegisteredIndex`.
+    '''
+    def __init__(self, codec: AddressCodec, keys, offsets, parts, order=None,
+                 source=None, options=None):
+        self.codec = codec
+        self.keys = keys
+        self.offsets = offsets
+        self.parts = parts
+        if order is None:
+            order = np.argsort(keys, kind='stable')
+        self.order = order
+        self.source = source
+        self.options = options
+
+    def __len__(self):
+        return len(self.keys)
+
+    def positions(self, keys: np.ndarray) -> np.ndarray:
+        '''
+        sorted positions of the records whose keys are among the given ones
+        '''
+        keys = np.unique(np.asarray(keys, dtype=np.int64))
+        ordered = self.keys[self.order]
+        i = np.searchsorted(ordered, keys, side='left')
+        j = np.searchsorted(ordered, keys, side='right')
+        hits = [self.order[a:b] for a, b in zip(i, j) if a < b]
+        if not hits:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate(hits))
+
+    def stale(self, path, options) -> bool:
+        return options != self.options or changed(self.source, path)
+
+    def save(self, path):
+        dump(path, UNIVERSE_MAGIC, {
+            'count': len(self.keys),
+            'source': self.source,
+            'options': self.options,
+            'cities': list(self.codec.cities),
+            'streets': list(self.codec.streets),
+            'numbers': list(self.codec.numbers),
+        }, [self.keys, self.offsets, self.parts, self.order])
+
+    @classmethod
+    def load(cls, path):
+        header, arrays = mapped(path, UNIVERSE_MAGIC, 4)
+        codec = AddressCodec(header['cities'], header['streets'],
+                             header['numbers'])
+        return cls(codec, *arrays, header['source'], header['options'])
+
+
+def is_index(path) -> bool:
+    'whether the file at the given path is a saved `RegisteredIndex`'
+    with open(path, 'rb') as istrm:
+        return istrm.read(len(MAGIC)) == MAGIC
+
+
+def open_index(path, source=None):
+    '''
+    open_index() loads the index saved at the given path, (re)building it
+    from the BoE registration file `source` first if it doesn't exist or is
+    stale; if `source` is omitted, the file the index was built from is
+    checked instead, provided it still exists.
+    '''
+    index = None
+    if os.path.exists(path):
+        index = RegisteredIndex.load(path)
+        if source is None and index.source is not None:
+            if os.path.exists(index.source['path']):
+                source = index.source['path']
+        if source is None or not index.stale(source):
+            return index
+    if source is None:
+        raise FileNotFoundError(f'{path}: no such index, and no registration'
+                                ' file to build it from')
+    index = RegisteredIndex.fromcsv(source)
+    index.save(path)
+    return RegisteredIndex.load(path)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser('build an index of registered addresses for'
+                            ' reuse across exclusion runs')
+    parser.add_argument('--registered',
+                        help='path from which to read registrant address set',
+                        required=True)
+    parser.add_argument('--opath',
+                        help='path to which to write the index',
+                        required=True)
+    parser.add_argument('--force',
+                        help='if present, rebuild even if the index is fresh',
+                        action='store_true')
+    args = parser.parse_args()
+    if args.force and os.path.exists(args.opath):
+        os.remove(args.opath)
+    index = open_index(args.opath, args.registered)
+    print(f'{args.opath}: {len(index)} registered addresses')
@@ -0,0 +1,343 @@
+import csv
+import json
+import os
+import platform
+import queue
+import random
+import resource
+import subprocess
+import time
+import multiprocessing as mp
+from common import MonroeCtRecord
+
+# municipality, ZIP and school district of each synthetic parcel
+MUNICIPALITIES = [
+    ('ROCHESTER', '14604', 'ROCHESTER'), ('ROCHESTER', '14607', 'ROCHESTER'),
+    ('ROCHESTER', '14609', 'ROCHESTER'), ('ROCHESTER', '14611', 'ROCHESTER'),
+    ('ROCHESTER', '14613', 'ROCHESTER'), ('ROCHESTER', '14620', 'ROCHESTER'),
+    ('BRIGHTON', '14610', 'BRIGHTON'), ('BRIGHTON', '14618', 'BRIGHTON'),
+    ('GREECE', '14612', 'GREECE'), ('GREECE', '14626', 'GREECE'),
+    ('IRONDEQUOIT', '14617', 'WEST IRONDEQUOIT'),
+    ('IRONDEQUOIT', '14622', 'EAST IRONDEQUOIT'),
+    ('HENRIETTA', '14467', 'RUSH-HENRIETTA'),
+    ('PITTSFORD', '14534', 'PITTSFORD'), ('PENFIELD', '14526', 'PENFIELD'),
+    ('WEBSTER', '14580', 'WEBSTER'), ('GATES', '14624', 'GATES-CHILI'),
+    ('CHILI', '14514', 'CHURCHVILLE-CHILI'),
+    ('FAIRPORT', '14450', 'FAIRPORT'), ('BROCKPORT', '14420', 'BROCKPORT'),
+]
+NAMES = ['Main', 'Park', 'Lake', 'East', 'Monroe', 'Clinton', 'Elm', 'Oak',
+         'Maple', 'Herald', 'Harold', 'Winton', 'Culver', 'Goodman',
+         'Dewey', 'Lyell', 'Jefferson', 'Genesee', 'Ridge', 'Latta',
+         'Titus', 'Portland', 'Hudson', 'Chili', 'Buffalo', 'Mt Hope',
+         'University', 'Atlantic', 'Norton', 'Empire', 'Blossom', 'Highland',
+         'Edgewood', 'Browncroft', 'Merchants', 'Saint Paul', 'Lexington',
+         'Thurston', 'Plymouth', 'Arnett', 'Avenue A', 'Garson', 'Bay']
+QUALIFIERS = ['St', 'Street', 'Ave', 'Avenue', 'Rd', 'Road', 'Dr', 'Drive',
+              'Cir', 'Circle', 'Blvd', 'Boulevard', 'Ln', 'Lane', 'Pl', 'Pkwy',
+              'Ter', 'Way', 'Trl', 'Ct']
+DIRECTIONS = ['N', 'S', 'E', 'W', 'North', 'South', 'East', 'West']
+# property classes, weighted roughly like a county roll
+PROPERTIES = [('1 Family Res', 70), ('2 Family Res', 10),
+              ('3 Family Res', 3), ('Apartment', 5), ('Row Building', 2),
+              ('Commercial', 5), ('Vacant Land', 3), ('Mfg Housing', 2)]
+PARTIES = [('DEM', 40), ('REP', 25), ('BLK', 25), ('IND', 4), ('CON', 2),
+           ('WOR', 2), ('GRE', 1), ('LBT', 1)]
+BOE_WIDTH = 39
+
+
+def weighted(rnd, choices):
+    labels, weights = zip(*choices)
+    return rnd.choices(labels, weights)[0]
+
+
+def streetName(rnd):
+    name = f'{rnd.choice(NAMES)} {rnd.choice(QUALIFIERS)}'
+    if rnd.random() < 0.15:
+        name = f'{rnd.choice(DIRECTIONS)} {name}'
+    elif rnd.random() < 0.05:
+        name = f'{name} {rnd.choice(DIRECTIONS)}'
+    return name
+
+
+def houseNumber(rnd, bulk):
+    '''
+    house number of a synthetic parcel: mostly plain numbers, with ranges
+    like '10-48' and '3&5' concentrated on bulk properties, and some '5 1/2'
+    '''
+    n = int(rnd.paretovariate(1.2) * 8)
+    r = rnd.random()
+    if bulk and r < 0.4:
+        span = 2 * rnd.randrange(1, 40 if r < 0.1 else 8)
+        return f'{n}-{n + span}'
+    if r < 0.02:
+        return f'{n}&{n + 2}'
+    if r < 0.04:
+        return f'{n} 1/2'
+    if r < 0.045:
+        return f'{n}{rnd.choice("ABC")}'
+    return str(n)
+
+
+def synthesize(directory, rows, seed=0):
+    '''
+    write a synthetic parcel roll of the given number of rows, shaped like
+    Monroe County's, and two BoE registration snapshots of roughly as many
+    voters living at its addresses, with churn between them; returns the
+    paths of the files, reusing any written before with the same arguments
+    '''
+    os.makedirs(directory, exist_ok=True)
+    paths = {k: os.path.join(directory, f'{k}-{rows}-{seed}.csv')
+             for k in ('universe', 'old', 'new')}
+    if all(os.path.exists(p) for p in paths.values()):
+        return paths
+    rnd = random.Random(seed)
+    streets = [[streetName(rnd) for _ in range(max(4, rows // 400))]
+               for _ in MUNICIPALITIES]
+    voters = []
+    with open(paths['universe'], 'w', newline='') as ostrm:
+        stenographer = csv.writer(ostrm)
+        stenographer.writerow([k.upper() for k in MonroeCtRecord.__slots__])
+        for i in range(rows):
+            m = rnd.randrange(len(MUNICIPALITIES))
+            city, zipcode, school = MUNICIPALITIES[m]
+            street = rnd.choice(streets[m])
+            prop = weighted(rnd, PROPERTIES)
+            nr = houseNumber(rnd, 'family res' not in prop.lower())
+            stenographer.writerow([
+                str(i), f'{i // 1000}.{i % 1000:03d}-1-{rnd.randrange(99)}',
+                nr, street, street.upper(), '', street, '',
+                f'OWNER {i}', '', '', '', prop, school, city, zipcode, city,
+                f'{nr} {street}', '', '', f'POLL {m}', ''])
+            # residents: registrations at roughly every parcel, living at
+            # the first member of any range
+            base = nr.split('-')[0].split('&')[0]
+            for _ in range(rnd.choice((0, 1, 1, 1, 2))):
+                voters.append([zipcode, base, street, rnd.randrange(1, 200)])
+    vids = list(range(len(voters)))
+    parties = [weighted(rnd, PARTIES) for _ in voters]
+
+    def snapshot(path, members):
+        with open(path, 'w', newline='') as ostrm:
+            stenographer = csv.writer(ostrm)
+            stenographer.writerow(['vid'] + [f'field{k}'
+                                             for k in range(1, BOE_WIDTH)])
+            for v in members:
+                zipcode, nr, street, district = voters[v]
+                row = [''] * BOE_WIDTH
+                row[0] = f'NY{v:018d}'
+                row[5] = nr
+                row[6] = street
+                # parcels are matched to registrations on ZIP, which
+                # `exclusion.registered()` reads from the city column
+                row[11] = zipcode
+                row[12] = 'NY'
+                row[13] = zipcode
+                row[25] = parties[v]
+                row[29] = str(district)
+                stenographer.writerow(row)
+
+    # churn: ~3% of voters drop off, ~4% register anew, ~2% switch party
+    rnd.shuffle(vids)
+    fresh = int(len(vids) * 0.04)
+    old = sorted(vids[fresh:])
+    new = [v for v in vids if rnd.random() > 0.03]
+    snapshot(paths['old'], old)
+    for v in rnd.sample(old, int(len(old) * 0.02)):
+        parties[v] = weighted(rnd, PARTIES)
+    snapshot(paths['new'], sorted(new))
+    return paths
+
+
+def countRows(path):
+    with open(path) as istrm:
+        return sum(1 for _ in istrm) - 1
+
+
+def stageNormalize(paths):
+    from common import StreetNormalizer
+    from ingest import parcelBatches
+    normalizer = StreetNormalizer()
+    n = 0
+    for batch in parcelBatches(paths['universe'], fields=('gis_st_name',)):
+        for street in batch['gis_st_name']:
+            normalizer.normalize(street)
+        n += len(batch)
+    return n
+
+
+def stageAddressRecords(paths):
+    from common import addressRecords
+    with open(paths['universe']) as istrm:
+        records = addressRecords(istrm)
+        next(records)
+        return sum(1 for _ in records)
+
+
+def stageRegisteredIndex(paths):
+    from addrindex import RegisteredIndex
+    RegisteredIndex.fromcsv(paths['old'])
+    return countRows(paths['old'])
+
+
+def stageExclusion(paths):
+    from addrindex import RegisteredIndex
+    from exclusion import vexclusion
+    from store import parcelStore, storeRecords
+    index = RegisteredIndex.fromcsv(paths['old'])
+    U = storeRecords(parcelStore(paths['universe']))
+    for ent in vexclusion(U, index, False, -1):
+        ent.tuple()
+    return countRows(paths['universe'])
+
+
+def stageExclusionGenerator(paths):
+    from common import addressRecords
+    from exclusion import exclusion, registered
+    with open(paths['old']) as istrm:
+        R = set(registered(istrm))
+    with open(paths['universe']) as istrm:
+        U = addressRecords(istrm)
+        next(U)
+        for ent in exclusion(U, R, False, -1):
+            ent.tuple()
+    return countRows(paths['universe'])
+
+
+def stageStratify(paths):
+    from deltaroll import stratify
+    stratify(paths['old'], paths['new'])
+    return countRows(paths['old']) + countRows(paths['new'])
+
+
+def stageStratifyStream(paths):
+    from deltaroll import stratifyStream
+    stratifyStream(paths['old'], paths['new'], max_memory=64 << 20)
+    return countRows(paths['old']) + countRows(paths['new'])
+
+
+STAGES = {
+    'normalize': stageNormalize,
+    'addressRecords': stageAddressRecords,
+    'registered-index': stageRegisteredIndex,
+    'exclusion': stageExclusion,
+    'exclusion-generator': stageExclusionGenerator,
+    'stratify': stageStratify,
+    'stratify-stream': stageStratifyStream,
+}
+
+
+def _measure(stage, paths, results):
+    try:
+        start = time.perf_counter()
+        rows = STAGES[stage](paths)
+        elapsed = time.perf_counter() - start
+    except Exception as e:
+        results.put((None, f'{e.__class__.__name__}: {e}'))
+        raise
+    # ru_maxrss is in KiB on Linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    results.put(((rows, elapsed, rss * 1024), None))
+
+
+class StageFailed(Exception):
+    pass
+
+
+def measure(stage, paths, poll=1.0):
+    '''
+    run a stage in a fresh process, so that its peak RSS is its own, and
+    return its row count, wall time and peak RSS in bytes; raises
+    `StageFailed` if the stage raises, or its process dies without
+    reporting back (e.g. killed for running out of memory)
+    '''
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    worker = ctx.Process(target=_measure, args=(stage, paths, results))
+    worker.start()
+    while True:
+        try:
+            result, error = results.get(timeout=poll)
+            break
+        except queue.Empty:
+            if worker.is_alive():
+                continue
+            # it may have reported back just before exiting
+            try:
+                result, error = results.get(timeout=poll)
+            except queue.Empty:
+                result = None
+                error = f'exited with code {worker.exitcode}'
+            break
+    worker.join()
+    if error is not None:
+        raise StageFailed(error)
+    return result
+
+
+def parseCount(count: str) -> int:
+    count = count.strip().lower()
+    scale = {'k': 10 ** 3, 'm': 10 ** 6}.get(count[-1:], 1)
+    if scale != 1:
+        count = count[:-1]
+    return int(float(count) * scale)
+
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser('benchmark the address and registration pipelines'
+                            ' against synthetic data')
+    parser.add_argument('--rows', help='comma-separated input sizes',
+                        default='10k,1m,5m')
+    parser.add_argument('--stages', help=('comma-separated stages to run, of '
+                                          + ', '.join(STAGES)),
+                        default=','.join(STAGES))
+    parser.add_argument('--data', help='directory in which to keep inputs',
+                        default='bench_data')
+    parser.add_argument('--seed', type=int, help='random seed', default=0)
+    parser.add_argument('--opath', help='path to which to write results',
+                        default='bench.json')
+    args = parser.parse_args()
+
+    stages = args.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error(f'unknown stage: {stage}')
+    report = {
+        'revision': revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'seed': args.seed,
+        'results': [],
+    }
+    print(f'{"stage":<20} {"rows":>9} {"seconds":>9} {"rows/s":>11}'
+          f' {"peak RSS":>10}')
+    for size in map(parseCount, args.rows.split(',')):
+        paths = synthesize(args.data, size, args.seed)
+        for stage in stages:
+            try:
+                rows, elapsed, rss = measure(stage, paths)
+            except StageFailed as e:
+                report['results'].append({'stage': stage, 'size': size,
+                                          'error': str(e)})
+                print(f'{stage:<20} failed: {e}')
+                continue
+            report['results'].append({
+                'stage': stage, 'size': size, 'rows': rows,
+                'seconds': elapsed, 'rows_per_sec': rows / elapsed,
+                'peak_rss_bytes': rss})
+            print(f'{stage:<20} {rows:>9} {elapsed:>9.2f} {rows/elapsed:>11.0f}'
+                  f' {rss / 2**20:>8.0f}Mi')
+    with open(args.opath, 'w') as ostrm:
+        json.dump(report, ostrm, indent=2)
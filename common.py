@@ -1,10 +1,16 @@
 import csv
 import re
+import sys
+import threading
+from collections import OrderedDict
 from usps_abbv import ABBREVIATIONS as ABBV
-from math import floor
+from math import floor, isfinite
 import itertools as it
+import numpy as np
+import instrument
 
 HALFPATTERN = re.compile('([0-9]+) 1/2?')
+NUMBERPATTERN = re.compile('(0|[1-9][0-9]*)(\\.5)?')
 
 
 class StreetAddress(object):
@@ -31,8 +37,12 @@ class StreetAddress(object):
     _qualifiers = set(it.chain(ABBV.keys(), ABBV.values()))
 
     @classmethod
-    # N Herald Circle -> heraldcircle north internally
     def normalize(cls, street):
+        return cls.normalizer.normalize(street)
+
+    @classmethod
+    # N Herald Circle -> heraldcircle north internally
+    def canonicalize(cls, street):
         street = street.lower().strip()
         tokens = street.split()
         for i in reversed(range(len(tokens))):
@@ -64,7 +74,225 @@ class StreetAddress(object):
         return hash(self) == hash(other)
 
 
-class MonroeCtRecord(object):
+class StreetNormalizer(object):
+    '''
+    bounded LRU cache in front of `StreetAddress.canonicalize`, so that each
+    distinct spelling of a street is only canonicalized once while it stays
+    in use, and every occurrence of a canonical form shares one interned
+    string. Safe to share between threads.
+    '''
+    def __init__(self, maxsize=1 << 16):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def normalize(self, street: str) -> str:
+        with self.lock:
+            return self._normalize(street)
+
+    def _normalize(self, street: str) -> str:
+        canon = self.cache.get(street)
+        if canon is not None:
+            self.hits += 1
+            self.cache.move_to_end(street)
+            return canon
+        self.misses += 1
+        with instrument.profiler.stage('normalize') as stage:
+            canon = sys.intern(StreetAddress.canonicalize(street))
+            stage.rows += 1
+        self.cache[street] = canon
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+        return canon
+
+    def normalize_many(self, streets) -> list:
+        '''
+        canonicalize a column of street names in one pass, taking the lock
+        once rather than once per name
+        '''
+        with self.lock:
+            return [self._normalize(street) for street in streets]
+
+
+StreetAddress.normalizer = StreetNormalizer()
+
+
+class AddressCodec(object):
+    '''
+    dictionary-encode the city, normalized street and house number of an
+    address into a single int64 key laid out as
+
+        city id (21 bits) | street id (22 bits) | house number x 2 (20 bits)
+
+    so that membership tests against registered addresses can run over
+    integer arrays instead of sets of `StreetAddress` objects. House numbers
+    that aren't in canonical decimal form (e.g. '12A', '010') get an id from a
+    separate dictionary above NUMBER_SPLIT, so two keys are equal exactly when
+    the `StreetAddress.tuple()`s they were encoded from are.
+
+    Encoding adds new cities, streets and house numbers to the codec's
+    dictionaries, so only one thread may encode with a codec at a time; any
+    number may `lookup()` addresses in it at once, since lookups add
+    nothing.
+    '''
+    CITY_SHIFT = 42
+    STREET_SHIFT = 20
+    NUMBER_SPLIT = 1 << 19
+    # key `lookup()` gives addresses the codec has no id for some part of;
+    # keys are never negative, so it matches none
+    UNKNOWN = -1
+    # how many ids each dictionary fits in its field of the key
+    CITY_LIMIT = 1 << (63 - CITY_SHIFT)
+    STREET_LIMIT = 1 << (CITY_SHIFT - STREET_SHIFT)
+    NUMBER_LIMIT = (1 << STREET_SHIFT) - NUMBER_SPLIT
+
+    def __init__(self, cities=(), streets=(), numbers=()):
+        self.cities = {k: i for i, k in enumerate(cities)}
+        self.streets = {k: i for i, k in enumerate(streets)}
+        self.numbers = {k: i for i, k in enumerate(numbers)}
+
+    @staticmethod
+    def _intern(table, k, limit, what):
+        i = table.get(k)
+        if i is None:
+            i = len(table)
+            if i >= limit:
+                # any more would run into the neighbouring field of the key
+                raise OverflowError(f'more than {limit} distinct {what}'
+                                    f' to encode')
+            table[k] = i
+        return i
+
+    def city(self, city: str) -> int:
+        return self._intern(self.cities, city, self.CITY_LIMIT, 'cities')
+
+    def street(self, street: str) -> int:
+        'id of an already-normalized street name'
+        return self._intern(self.streets, street, self.STREET_LIMIT,
+                            'streets')
+
+    def rawstreet(self, street: str) -> int:
+        'id of a street name as it appears in the input'
+        return self.street(StreetAddress.normalize(street))
+
+    def rawstreets(self, streets) -> np.ndarray:
+        'ids of a column of street names as they appear in the input'
+        canon = StreetAddress.normalizer.normalize_many(streets)
+        return np.fromiter(map(self.street, canon), dtype=np.int64,
+                           count=len(canon))
+
+    def _doubled(self, nr: str):
+        # twice a house number in canonical form, if it fits below the split
+        match = NUMBERPATTERN.fullmatch(nr)
+        if match is not None:
+            n2 = 2 * int(match.group(1)) + (match.group(2) is not None)
+            if n2 < self.NUMBER_SPLIT:
+                return n2
+        return None
+
+    def number(self, nr: str) -> int:
+        n2 = self._doubled(nr)
+        if n2 is not None:
+            return n2
+        return self.NUMBER_SPLIT + self._intern(
+            self.numbers, nr, self.NUMBER_LIMIT,
+            'non-canonical house numbers')
+
+    def pack(self, city: int, street: int, number: int) -> int:
+        return ((city << self.CITY_SHIFT)
+                | (street << self.STREET_SHIFT)
+                | number)
+
+    def key(self, addr: 'StreetAddress') -> int:
+        return self.pack(self.city(addr.city), self.street(addr.street),
+                         self.number(addr.number))
+
+    def rawkey(self, city: str, street: str, nr: str) -> int:
+        'equivalent to `self.key(StreetAddress(city, street, nr))`'
+        if ' ' in nr:
+            nr = re.sub(HALFPATTERN, r'\1.5', nr)
+        return self.pack(self.city(city), self.rawstreet(street),
+                         self.number(nr))
+
+    def known(self, city: str, street: str):
+        '''
+        the ids of a city and a street name as it appears in the input, or
+        None if the codec has no id for either; adds nothing to the codec
+        '''
+        c = self.cities.get(city)
+        if c is None:
+            return None
+        s = self.streets.get(StreetAddress.normalize(street))
+        if s is None:
+            return None
+        return c, s
+
+    def lookup(self, city: str, street: str, nr: str) -> int:
+        '''
+        `self.rawkey(city, street, nr)` if the codec has an id for each part
+        of the address, or else `UNKNOWN`; adds nothing to the codec
+        '''
+        ids = self.known(city, street)
+        if ids is None:
+            return self.UNKNOWN
+        if ' ' in nr:
+            nr = re.sub(HALFPATTERN, r'\1.5', nr)
+        n2 = self._doubled(nr)
+        if n2 is None:
+            n2 = self.numbers.get(nr)
+            if n2 is None:
+                return self.UNKNOWN
+            n2 += self.NUMBER_SPLIT
+        return self.pack(*ids, n2)
+
+    def encode(self, addrs) -> np.ndarray:
+        'encode an iterable of `StreetAddress`es'
+        return np.fromiter((self.key(a) for a in addrs), dtype=np.int64)
+
+    def encode_records(self, records) -> np.ndarray:
+        'encode the addresses of an iterable of `MonroeCtRecord`s'
+        return np.fromiter((self.rawkey(r.par_zip, r.gis_st_name, r.st_nbr)
+                            for r in records), dtype=np.int64)
+
+    def lookup_records(self, records) -> np.ndarray:
+        '''
+        `lookup()` the addresses of an iterable of `MonroeCtRecord`s: their
+        keys, or `UNKNOWN` for those the codec has no id for some part of
+        '''
+        return np.fromiter((self.lookup(r.par_zip, r.gis_st_name, r.st_nbr)
+                            for r in records), dtype=np.int64)
+
+
+def canon(nr: str, st: str, city: str) -> str:
+    'the CANON field of a parcel: its one-line mailing address'
+    return f'{nr} {st}, {city}, NY, USA'
+
+
+class ParcelMixin(object):
+    '''
+    the methods shared by the parcel record classes, `MonroeCtRecord` and
+    the `store.ParcelView`s standing in for it
+    '''
+    __slots__ = ()
+
+    def address(self) -> StreetAddress:
+        return StreetAddress(self.par_zip, self.gis_st_name, self.st_nbr)
+
+    def tuple(self):
+        rtn = [getattr(self, k) for k in MonroeCtRecord.__slots__]
+        rtn.append(str(self))
+        return tuple(rtn)
+
+    def __str__(self):
+        return canon(self.st_nbr, self.gis_st_name, self.city)
+
+    def is_bulk(self):
+        return 'family res' not in self.prop_desc.lower()
+
+
+class MonroeCtRecord(ParcelMixin):
     __slots__ = ("object_id", "print_key", "st_nbr", "gis_st_name",
                  "rps_st_name", "loc_pre_dir", "loc_st_name", "loc_st_type",
                  "owner1", "owner2", "own_addr", "own_addr_2", "prop_desc",
@@ -81,20 +309,12 @@ class MonroeCtRecord(object):
                 setattr(self, k, next(row))
         self.st_nbr = re.sub(HALFPATTERN, r'\1.5', self.st_nbr)
 
-    def address(self) -> StreetAddress:
-        return StreetAddress(self.par_zip, self.gis_st_name, self.st_nbr)
-
-    def tuple(self):
-        rtn = [getattr(self, k) for k in self.__class__.__slots__]
-        rtn.append(str(self))
-        return tuple(rtn)
-
-    def __str__(self):
-        return (f'{self.st_nbr} {self.gis_st_name}'
-                f', {self.city}, NY, USA')
-
-    def is_bulk(self):
-        return 'family res' not in self.prop_desc.lower()
+    def derive(self, **fields):
+        'copy of the record with the given fields replaced'
+        x = self.__class__(self)
+        for k, v in fields.items():
+            setattr(x, k, v)
+        return x
 
 
 class BoERecord(object):
@@ -121,31 +341,58 @@ class AddressRange(object):
     def __init__(self, ent: MonroeCtRecord, start: float, end: float):
         if start > end:
             start, end = end, start
+        self.ent = ent
         self.start = start
         self.end = end
 
+    def _whole(self) -> range:
+        # whole house numbers from the start through the end, on the start's
+        # side of the street; a fractional start lies between two of them
+        a, b = self.start, self.end
+        lo = int(a) if floor(a) == a else int(a) + 2
+        return range(lo, int(b) + 1, 2)
+
     def __len__(self):
-        a = floor(self.start)
-        b = floor(self.end)
-        n = (b - a) // 2
-        if floor(b) != b:
-            n += 1
+        a, b = self.start, self.end
+        n = len(self._whole())
         if floor(a) != a:
             n += 1
+        if floor(b) != b and b != a:
+            n += 1
         return n
 
-    def __iter__(self):
+    def numbers(self):
+        '''
+        house numbers of the range's members, in order of iteration: both
+        ends, and every other whole number in between
+        '''
         a, b = self.start, self.end
-        enum = range(int(a), int(b), 2)
-        if floor(b) != b:
-            enum = it.chain(enum, (b,))
+        enum = list(self._whole())
         if floor(a) != a:
-            enum = it.chain((a,), enum)
+            enum.insert(0, a)
+        if floor(b) != b and b != a:
+            enum.append(b)
+        return enum
+
+    def member(self, n) -> MonroeCtRecord:
+        return self.ent.derive(st_nbr=str(n))
+
+    def __iter__(self):
+        for n in self.numbers():
+            yield self.member(n)
+
 
-        for n in enum:
-            x = MonroeCtRecord(self.ent)
-            x.st_nbr = str(n)
-            yield x
+class AddressEnds(AddressRange):
+    '''
+    a range too long to be plausible, e.g. a mistyped '1-99999', standing in
+    for only the addresses at either end
+    '''
+    def __len__(self):
+        return 2
+
+    def numbers(self):
+        return [int(n) if floor(n) == n else n
+                for n in (self.start, self.end)]
 
 
 def boeRecords(istrm):
@@ -153,6 +400,43 @@ def boeRecords(istrm):
     return (BoERecord(row) for row in rows)
 
 
+RANGEDELIM = re.compile('[-&/]')
+# most addresses a range may span before it's taken for a typo
+RANGE_LIMIT = 500
+
+
+def addressRecord(row):
+    '''
+    addressRecord() parses a row of the parcel roll into a `MonroeCtRecord`,
+    or into an `AddressRange` if its house number spans several addresses.
+    '''
+    return ranged(MonroeCtRecord(row))
+
+
+def ranged(ent):
+    '''
+    ranged() wraps a parcel record in an `AddressRange` if its house number
+    spans several addresses, or in an `AddressEnds` if it spans more than
+    RANGE_LIMIT of them.
+    '''
+    ends = RANGEDELIM.split(ent.st_nbr)
+    if len(ends) == 1:
+        return ent
+    try:
+        a, b = map(float, ends)
+        if not (isfinite(a) and isfinite(b)):
+            raise ValueError(ent.st_nbr)
+    except ValueError:
+        # e.g. '12A-14A', '1-3-5' or '1-inf'; keep it as a single address
+        instrument.profiler.count('unparseable ranges')
+        return ent
+    rng = AddressRange(ent, a, b)
+    if len(rng) > RANGE_LIMIT:
+        instrument.profiler.count('implausible ranges')
+        return AddressEnds(ent, a, b)
+    return rng
+
+
 def addressRecords(istrm):
     '''
     records() instantiates a generator that yields the input stream's file
@@ -160,14 +444,5 @@ def addressRecords(istrm):
     '''
     rows = csv.reader(istrm)
     yield next(rows)  # yield header
-    rangedelim = re.compile('[-&/]')
     for row in rows:
-        ent = MonroeCtRecord(row)
-        try:
-            a, b = rangedelim.split(ent.st_nbr)
-            enum = AddressRange(ent, float(a), float(b))
-            yield enum
-        except ValueError:
-            yield ent
-
-
+        yield addressRecord(row)
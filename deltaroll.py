@@ -1,8 +1,19 @@
 import csv
+import heapq
+import io
+import itertools as it
+import json
+import os
+import tempfile
+import zlib
 from collections import Counter
+from operator import itemgetter
 import pandas as pd
 import numpy as np
 from sys import stdout
+import instrument
+from addrindex import changed, fingerprint
+import ingest
 
 
 class BoEIndices(object):
@@ -16,7 +27,10 @@ class BoEIndices(object):
     suffix = 4
     houseNumber = 5
     street = 6
+    city = 11
+    zip = 13
     party = 25
+    electionDistrict = 29
 
 
 class Hist(Counter):
@@ -44,63 +58,476 @@ def prnHist(label, hist):
     print()
 
 
-def stratify(oldPath, newPath, by=BoEIndices.vid, key=BoEIndices.party):
+def snapshot(path, by, columns):
     '''
-    Stratify unique voter registrations by given affiliation column, with their
-    party affiliation as the default; returns a np.ndarray representing the
-    adjacency matrix of various affiliations between snapshots
-    '''
-    with open(args.old) as istrm:
-        oldReg = {r[by]: r[key] for r in csv.reader(istrm)}
-
-    with open(args.new) as istrm:
-        newReg = {r[by]: r[key] for r in csv.reader(istrm)}
-
-    for k in newReg:
-        if k not in oldReg:
-            oldReg[k] = 'New'
-
-    oldHist = Hist(oldReg.values())
-    newHist = Hist(newReg.values())
-    keys = list(set(oldReg.values()).union(set(newReg.values())))
-    keys.sort(key=lambda k: newHist[k], reverse=True)
-    keyidx = {k: i for i, k in enumerate(keys)}
-    for k in newReg:
-        if k not in oldReg:
-            oldReg[k] = 'New'
-
-    J = np.zeros((len(keys), len(keys)), dtype='int32')
-    for vid in set(oldReg.keys()).intersection(set(newReg.keys())):
-        i = keyidx[oldReg[vid]]
-        j = keyidx[newReg[vid]]
-        J[i, j] += 1
-    df = pd.DataFrame(J, index=keys, columns=keys)
-    drops = Hist(v for k, v in oldReg.items() if k not in newReg)
-    df.loc['Total'] = df.sum()
-    df.loc['Previous'] = np.array([oldHist[k] for k in keys])
-    df.loc['Net Change'] = np.array([newHist[k]-oldHist[k] for k in keys])
-    df.loc['Dropped'] = np.array([drops[k] for k in keys])
-    df.drop('New', axis=1, inplace=True)
+    read only the `by` and given columns of a registration snapshot, keeping
+    the last row of each distinct `by`; rows too short to hold them all are
+    skipped, as `sortedRecords()` skips them
+    '''
+    fields = sorted({by, *columns})
+    chunks = list(ingest.batches(path, {i: i for i in fields}, fields,
+                                 header=False))
+    df = (pd.concat(chunks, ignore_index=True) if chunks else
+          pd.DataFrame({i: pd.Series(dtype=str) for i in fields}))
+    n = len(df)
+    df = df.drop_duplicates(by, keep='last')
+    if len(df) < n:
+        instrument.profiler.count('duplicate rows', n - len(df))
     return df
 
 
+def ledger(labels, J, prev, cur, drops, groups=None):
+    '''
+    tabulate transition counts `J[g, i, j]` from label `i` to label `j`,
+    along with per-label counts before and after and drop counts, all indexed
+    by group `g`, into the adjacency table `stratify()` returns
+    '''
+    order = sorted(range(len(labels)), key=lambda i: (-cur[:, i].sum(),
+                                                      labels[i]))
+    keys = [labels[i] for i in order]
+    tables = []
+    for g in range(J.shape[0]):
+        df = pd.DataFrame(J[g][np.ix_(order, order)], index=keys, columns=keys)
+        df.loc['Total'] = df.sum()
+        df.loc['Previous'] = prev[g, order]
+        df.loc['Net Change'] = cur[g, order] - prev[g, order]
+        df.loc['Dropped'] = drops[g, order]
+        df.drop('New', axis=1, inplace=True, errors='ignore')
+        tables.append(df)
+    if groups is None:
+        return tables[0]
+    return pd.concat(tables, keys=groups)
+
+
+def stratify(oldPath, newPath, by=BoEIndices.vid, key=BoEIndices.party,
+             groups=()):
+    '''
+    Stratify unique voter registrations by given affiliation column, with their
+    party affiliation as the default; returns a pd.DataFrame representing the
+    adjacency matrix of various affiliations between snapshots. Given any
+    `groups` columns, e.g. `BoEIndices.electionDistrict`, voters are grouped
+    by their values in the latest snapshot they appear in, and one adjacency
+    matrix is tabulated for each group, all from the same pass.
+    '''
+    profiler = instrument.profiler
+    groups = list(groups)
+    with profiler.stage('read') as stage:
+        old = snapshot(oldPath, by, [key, *groups])
+        new = snapshot(newPath, by, [key, *groups])
+        stage.rows += len(old) + len(new)
+    with profiler.stage('join') as stage:
+        # position of each voter in the other snapshot, or -1
+        prior = pd.Index(old[by]).get_indexer(new[by])
+        dropped = pd.Index(new[by]).get_indexer(old[by]) < 0
+        stage.rows += len(new) + int(dropped.sum())
+        codes, labels = pd.factorize(np.concatenate([
+            old[key].to_numpy(), new[key].to_numpy()]))
+        G = pd.concat([new[groups], old[groups][dropped]]) if groups else None
+        return tabulate(prior, dropped, codes[:len(old)], codes[len(old):],
+                        list(labels), G)
+
+
+def tabulate(prior, dropped, oldCodes, newCodes, labels, G=None):
+    '''
+    tabulate the table `stratify()` returns from the position `prior` of each
+    voter of the new snapshot in the old one (or -1), the mask `dropped` of
+    voters of the old one missing from the new one, and the codes into
+    `labels` of every voter of either; given `G`, the group columns of the
+    new snapshot's voters followed by those of the dropped ones, one table
+    is tabulated per group
+    '''
+    labels = list(labels)
+    if 'New' not in labels:
+        labels.append('New')
+    K = len(labels)
+    prevCodes = np.where(prior < 0, labels.index('New'), oldCodes[prior])
+    if G is not None:
+        if G.shape[1] == 1:
+            gcodes, glabels = pd.factorize(G.iloc[:, 0], sort=True)
+        else:
+            index = pd.MultiIndex.from_frame(G)
+            gcodes, glabels = index.factorize(sort=True)
+        glabels = list(glabels)
+    else:
+        gcodes = np.zeros(len(newCodes) + dropped.sum(), dtype=np.int64)
+        glabels = None
+    ngroups = gcodes.max() + 1 if len(gcodes) else 1
+    newGroups = gcodes[:len(newCodes)]
+    dropGroups = gcodes[len(newCodes):]
+
+    J = np.bincount((newGroups * K + prevCodes) * K + newCodes,
+                    minlength=ngroups * K * K).reshape(ngroups, K, K)
+    prev = np.bincount(np.concatenate([newGroups * K + prevCodes,
+                                       dropGroups * K + oldCodes[dropped]]),
+                       minlength=ngroups * K).reshape(ngroups, K)
+    cur = np.bincount(newGroups * K + newCodes,
+                      minlength=ngroups * K).reshape(ngroups, K)
+    drops = np.bincount(dropGroups * K + oldCodes[dropped],
+                        minlength=ngroups * K).reshape(ngroups, K)
+    if not (prevCodes == labels.index('New')).any():
+        # no new registrations; don't tabulate a 'New' row
+        keep = [i for i, k in enumerate(labels) if k != 'New']
+        labels = [labels[i] for i in keep]
+        J = J[:, keep][:, :, keep]
+        prev, cur, drops = prev[:, keep], cur[:, keep], drops[:, keep]
+    return ledger(labels, J, prev, cur, drops, glabels)
+
+
+# rough per-row cost of a projected record held in memory, on top of the
+# lengths of its fields
+RECORD_OVERHEAD = 256
+
+
+def parse_size(size: str) -> int:
+    '''
+    parse a byte count with an optional K/M/G suffix, e.g. '512M'
+    '''
+    size = size.strip().upper().rstrip('B')
+    scale = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}.get(size[-1:], 1)
+    if scale != 1:
+        size = size[:-1]
+    return int(float(size) * scale)
+
+
+def sortedRecords(path, by, columns, max_memory):
+    '''
+    sortedRecords() instantiates a generator of the `by` and given columns of
+    each unique `by` in a registration snapshot, sorted by `by`, keeping the
+    last row of each like `snapshot()`. Rows are sorted in chunks of at most
+    about `max_memory` bytes, spilled to temporary files and merged. Like
+    `snapshot()`, blank lines are skipped, and so are rows too short to hold
+    every column, which are counted as 'short rows', and compressed
+    snapshots (e.g. '.gz') are decompressed as they're read.
+    '''
+    profiler = instrument.profiler
+    need = max(by, *columns) + 1
+    runs = []
+    chunk = []
+    size = 0
+    with io.TextIOWrapper(ingest.opened(path), encoding='utf-8',
+                          newline='') as istrm:
+        for seq, row in enumerate(csv.reader(istrm)):
+            if len(row) < need:
+                if row:
+                    profiler.count('short rows')
+                continue
+            # sort by vid, then row order, so the last row of each vid wins
+            record = (row[by], seq, *(row[i] for i in columns))
+            chunk.append(record)
+            size += RECORD_OVERHEAD + sum(len(row[i]) for i in (by, *columns))
+            if size >= max_memory:
+                runs.append(spill(chunk))
+                profiler.count('spilled runs')
+                chunk, size = [], 0
+    chunk.sort()
+    if runs:
+        runs.append(spill(chunk))
+        profiler.count('spilled runs')
+        merged = heapq.merge(*(readRun(run) for run in runs))
+    else:
+        merged = iter(chunk)
+    try:
+        for _, group in it.groupby(merged, key=itemgetter(0)):
+            duplicates = -1
+            for record in group:
+                duplicates += 1
+            if duplicates:
+                profiler.count('duplicate rows', duplicates)
+            yield (record[0], *record[2:])
+    finally:
+        for run in runs:
+            run.close()
+
+
+def spill(chunk):
+    chunk.sort()
+    run = tempfile.TemporaryFile('w+', newline='')
+    csv.writer(run).writerows(chunk)
+    run.seek(0)
+    return run
+
+
+def readRun(run):
+    for row in csv.reader(run):
+        row[1] = int(row[1])
+        yield tuple(row)
+
+
+def stratifyStream(oldPath, newPath, by=BoEIndices.vid, key=BoEIndices.party,
+                   groups=(), max_memory=256 << 20, changes=None):
+    '''
+    Produce the same table as `stratify()` from a sort-merge join of both
+    snapshots, holding only about `max_memory` bytes of either in memory at
+    once. If given, `changes` is called with the vid, previous and current
+    label of every voter whose label changed, with 'New' and 'Dropped'
+    standing in for voters missing from either snapshot.
+    '''
+    profiler = instrument.profiler
+    groups = list(groups)
+    columns = [key, *groups]
+    old = profiler.timed('read', sortedRecords(oldPath, by, columns,
+                                               max_memory))
+    new = profiler.timed('read', sortedRecords(newPath, by, columns,
+                                               max_memory))
+    with profiler.stage('join') as stage:
+        transitions = Counter()
+        prev = Counter()
+        cur = Counter()
+        drops = Counter()
+        a = next(old, None)
+        b = next(new, None)
+        while a is not None or b is not None:
+            if b is None or (a is not None and a[0] < b[0]):
+                # dropped
+                vid, label, group = a[0], a[1], a[2:]
+                prev[group, label] += 1
+                drops[group, label] += 1
+                if changes is not None:
+                    changes(vid, label, 'Dropped')
+                a = next(old, None)
+                continue
+            if a is None or b[0] < a[0]:
+                vid, label, group = b[0], 'New', b[2:]
+            else:
+                vid, label, group = b[0], a[1], b[2:]
+                a = next(old, None)
+            transitions[group, label, b[1]] += 1
+            prev[group, label] += 1
+            cur[group, b[1]] += 1
+            if changes is not None and label != b[1]:
+                changes(vid, label, b[1])
+            b = next(new, None)
+        stage.rows += sum(prev.values())
+
+        labels = sorted({k for _, k in prev} | {k for _, k in cur})
+        glabels = sorted({g for g, _ in prev})
+        if not glabels:
+            glabels = [()]
+        lidx = {k: i for i, k in enumerate(labels)}
+        gidx = {g: i for i, g in enumerate(glabels)}
+        J = np.zeros((len(glabels), len(labels), len(labels)), dtype=np.int64)
+        for (g, i, j), n in transitions.items():
+            J[gidx[g], lidx[i], lidx[j]] = n
+        tallies = []
+        for counts in (prev, cur, drops):
+            tally = np.zeros((len(glabels), len(labels)), dtype=np.int64)
+            for (g, k), n in counts.items():
+                tally[gidx[g], lidx[k]] = n
+            tallies.append(tally)
+        if not groups:
+            glabels = None
+        elif len(groups) == 1:
+            glabels = [g for g, in glabels]
+        return ledger(labels, J, *tallies, glabels)
+
+
+class SidecarCache(object):
+    '''
+    directory of binary sidecars of registration snapshots, each holding the
+    sorted unique vids of a snapshot and the codes of the given columns for
+    each, into label dictionaries shared by every sidecar in the directory,
+    so that each snapshot is only parsed once. Labels are only ever appended
+    to the dictionaries, so that existing sidecars stay valid.
+    '''
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.labelPath = os.path.join(directory, 'labels.json')
+        self.labels = {}
+        if os.path.exists(self.labelPath):
+            with open(self.labelPath) as istrm:
+                self.labels = json.load(istrm)
+        self.codes = {c: {k: i for i, k in enumerate(labels)}
+                      for c, labels in self.labels.items()}
+
+    def encode(self, column, values) -> np.ndarray:
+        codes, uniques = pd.factorize(values)
+        table = self.codes.setdefault(str(column), {})
+        labels = self.labels.setdefault(str(column), [])
+        for k in uniques:
+            if k not in table:
+                table[k] = len(labels)
+                labels.append(k)
+        remap = np.fromiter((table[k] for k in uniques), dtype=np.int32,
+                            count=len(uniques))
+        return remap[codes]
+
+    def saveLabels(self):
+        tmp = self.labelPath + '.tmp'
+        with open(tmp, 'w') as ostrm:
+            json.dump(self.labels, ostrm)
+        os.replace(tmp, self.labelPath)
+
+    def path(self, src, by, columns):
+        # distinguish snapshots of the same name in different directories
+        where = zlib.crc32(os.path.abspath(src).encode('utf-8'))
+        name = os.path.basename(src)
+        cols = '-'.join(map(str, (by, *columns)))
+        return os.path.join(self.directory, f'{name}.{where:08x}.{cols}.npz')
+
+    def load(self, src, by, columns):
+        '''
+        the sorted vids of a snapshot and a dict of the codes of its given
+        columns, read from its sidecar, which is (re)built first if missing
+        or stale
+        '''
+        path = self.path(src, by, columns)
+        if os.path.exists(path):
+            with np.load(path) as sidecar:
+                source = json.loads(str(sidecar['source']))
+                if not changed(source, src):
+                    return sidecar['vids'], {c: sidecar[f'c{c}']
+                                             for c in columns}
+        instrument.profiler.count('sidecars built')
+        df = snapshot(src, by, columns)
+        vids = np.array(df[by].str.encode('utf-8').tolist(), dtype=bytes)
+        order = np.argsort(vids, kind='stable')
+        vids = vids[order]
+        codes = {c: self.encode(c, df[c].to_numpy())[order] for c in columns}
+        self.saveLabels()
+        tmp = path[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp, vids=vids, source=json.dumps(fingerprint(src)),
+                 **{f'c{c}': codes[c] for c in columns})
+        os.replace(tmp, path)
+        return vids, codes
+
+
+def series(paths, by=BoEIndices.vid, key=BoEIndices.party, groups=(),
+           cache='.deltaroll'):
+    '''
+    Tabulate the table `stratify()` would for each consecutive pair of the
+    given snapshots, reading them through a `SidecarCache` in the directory
+    `cache`; returns the list of tables, along with a pd.DataFrame of the
+    net change in voters of each label between each pair, indexed by the
+    later snapshot of the pair.
+    '''
+    profiler = instrument.profiler
+    groups = list(groups)
+    columns = sorted({key, *groups})
+    sidecars = SidecarCache(cache)
+    with profiler.stage('read') as stage:
+        snaps = [sidecars.load(path, by, columns) for path in paths]
+        stage.rows += sum(len(vids) for vids, _ in snaps)
+    labels = {c: np.array(sidecars.labels[str(c)], dtype=object)
+              for c in columns}
+    tables = []
+    with profiler.stage('join') as stage:
+        for (oldVids, old), (newVids, new) in zip(snaps, snaps[1:]):
+            # vids are sorted, so voters can be looked up by bisection
+            prior = np.full(len(newVids), -1, dtype=np.int64)
+            if len(oldVids):
+                idx = np.searchsorted(oldVids, newVids)
+                idx[idx == len(oldVids)] = 0
+                found = oldVids[idx] == newVids
+                prior[found] = idx[found]
+            dropped = np.ones(len(oldVids), dtype=bool)
+            dropped[prior[prior >= 0]] = False
+            stage.rows += len(newVids) + int(dropped.sum())
+            # compact the shared codes to the labels this pair uses
+            present, codes = np.unique(np.concatenate([old[key], new[key]]),
+                                       return_inverse=True)
+            G = None
+            if groups:
+                G = pd.DataFrame({g: labels[g][np.concatenate([
+                    new[g], old[g][dropped]])] for g in groups})
+            tables.append(tabulate(prior, dropped, codes[:len(oldVids)],
+                                   codes[len(oldVids):],
+                                   labels[key][present].tolist(), G))
+    net = [t.loc['Net Change'] if not groups
+           else t.xs('Net Change', level=-1).sum() for t in tables]
+    net = pd.DataFrame(net, index=list(paths[1:])).fillna(0).astype(int)
+    return tables, net
+
+
 if __name__ == '__main__':
     from argparse import ArgumentParser
     parser = ArgumentParser('catalog changes between two voter'
                             ' registration snapshots')
     parser.add_argument('--old', help=('path from which to read the ascendant'
-                                       ' snapshot'), required=True)
+                                       ' snapshot'), default=None)
     parser.add_argument('--new', help=('path from which to read the descendant'
-                                       ' snapshot'), required=True)
+                                       ' snapshot'), default=None)
+    parser.add_argument('--series', help=('paths of a series of snapshots,'
+                                          ' oldest first, to tabulate the'
+                                          ' changes between each consecutive'
+                                          ' pair of instead of --old and'
+                                          ' --new'),
+                        nargs='+', default=None)
+    parser.add_argument('--cache', help=('directory in which to keep binary'
+                                         ' sidecars of each snapshot of'
+                                         ' --series, so that each is only'
+                                         ' parsed once'),
+                        default='.deltaroll')
+    parser.add_argument('--net', help=('if present, only report the net'
+                                       ' change in voters of each label'
+                                       ' between each pair of --series'),
+                        action='store_true')
     parser.add_argument('--summarize', help='summarize changes',
                         action='store_true')
+    parser.add_argument('--key', help='column by which to stratify voters',
+                        default='party')
+    parser.add_argument('--group', help=('column by which to group voters;'
+                                         ' may be given more than once'),
+                        action='append', default=[])
+    parser.add_argument('--stream', help=('if present, diff the snapshots'
+                                          ' with an external sort-merge'
+                                          ' join in bounded memory'),
+                        action='store_true')
+    parser.add_argument('--max-memory', help=('approx. memory budget for'
+                                              ' --stream, e.g. 512M'),
+                        default='256M')
+    parser.add_argument('--changes', help=('path to which to write the vid,'
+                                           ' previous and current label of'
+                                           ' each changed voter; implies'
+                                           ' --stream'),
+                        default=None)
+    instrument.add_argument(parser)
     args = parser.parse_args()
+    if args.series is not None:
+        if args.old is not None or args.new is not None:
+            parser.error('--series is exclusive of --old and --new')
+        if len(args.series) < 2:
+            parser.error('--series requires at least two snapshots')
+        if args.stream or args.changes is not None:
+            parser.error('--series can\'t be combined with --stream')
+    elif args.old is None or args.new is None:
+        parser.error('either --old and --new, or --series, are required')
+    elif args.net:
+        parser.error('--net requires --series')
+    if args.profile is not None:
+        instrument.enable()
 
     # if args.summarize:
-    ledger = stratify(args.old, args.new)
-    if stdout.isatty():
-        print('Adjacency:')
-        print(ledger)
+    key = getattr(BoEIndices, args.key)
+    groups = [getattr(BoEIndices, g) for g in args.group]
+    if args.series is not None:
+        tables, net = series(args.series, key=key, groups=groups,
+                             cache=args.cache)
+        table = net if args.net else pd.concat(tables, keys=args.series[1:])
+    elif args.stream or args.changes is not None:
+        ostrm = None
+        changes = None
+        if args.changes is not None:
+            ostrm = open(args.changes, 'w', newline='')
+            stenographer = csv.writer(ostrm)
+            stenographer.writerow(('vid', 'previous', 'current'))
+            changes = lambda *row: stenographer.writerow(row)
+        try:
+            table = stratifyStream(args.old, args.new, key=key, groups=groups,
+                                   max_memory=parse_size(args.max_memory),
+                                   changes=changes)
+        finally:
+            if ostrm is not None:
+                ostrm.close()
     else:
-        stdout.write(ledger.to_csv().replace('\r\n', '\n'))
+        table = stratify(args.old, args.new, key=key, groups=groups)
+    with instrument.profiler.stage('write') as stage:
+        if stdout.isatty():
+            print('Adjacency:')
+            print(table)
+        else:
+            stdout.write(table.to_csv().replace('\r\n', '\n'))
+        stage.rows += len(table)
+    if args.profile is not None:
+        instrument.profiler.dump(args.profile)
     exit()
@@ -1,19 +1,36 @@
 import csv
+import gzip
+import heapq
+import io
 import itertools as it
-from common import StreetAddress, addressRecords
+import os
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+from common import (AddressCodec, AddressRange, StreetAddress,
+                    addressRecord, addressRecords)
+from addrindex import (RegisteredIndex, UniverseIndex, fingerprint,
+                       is_index, open_index)
+from store import (RANGECHARS, ParcelView, RecordStore, parcelStore,
+                   storeRecords)
+from fuzzy import MIN_CONFIDENCE, NearMatcher, unmatched
+import ingest
+import instrument
+import output
 
 
-def registered(istrm):
+BOEIDX_CITY = 11
+BOEIDX_DLVY_NR = 5
+BOEIDX_DLVY_ST = 6
+# BOEIDX_ZIP = 13
+
+
+def registrants(rows):
     '''
-    registered() instantiates a generator of BoE registered addresses from
-    the input stream.
+    registrants() instantiates a generator of the addresses of the given
+    BoE registration rows, skipping (and counting) rows without one.
     '''
-    BOEIDX_CITY = 11
-    BOEIDX_DLVY_NR = 5
-    BOEIDX_DLVY_ST = 6
-    # BOEIDX_ZIP = 13
-    rows = csv.reader(istrm)
-    next(rows)  # discard header
+    profiler = instrument.profiler
     for ent in rows:
         try:
             record = StreetAddress(
@@ -22,29 +39,389 @@ def registered(istrm):
                 ent[BOEIDX_DLVY_ST],
                 ent[BOEIDX_DLVY_NR])
         except Exception:
+            profiler.count('parse failures')
             continue
         yield record
 
 
-def exclusion(universe, registered, unrollp, unroll_max):
+def registered(istrm):
+    '''
+    registered() instantiates a generator of BoE registered addresses from
+    the input stream.
+    '''
+    rows = csv.reader(istrm)
+    next(rows)  # discard header
+    return registrants(rows)
+
+
+def queued(universe, unrollp, unroll_max):
+    '''
+    queued() instantiates a generator of the records `exclusion()` tests
+    against the registered set, in the order it tests them: single addresses
+    first, followed by each range. Ranges short enough to unroll in full are
+    yielded as `AddressRange`s, the rest as tuples of their end records.
+    '''
+    profiler = instrument.profiler
     if unrollp:
-        queue = (ent for ent in universe if hasattr(ent, '__iter__'))
-    else:
-        queue = universe
-    for ent in queue:
+        universe = (ent for ent in universe if hasattr(ent, '__iter__'))
+    ranges = []
+    for ent in universe:
         if hasattr(ent, '__iter__'):
             if unroll_max < 0 or len(ent) <= unroll_max:
-                queue = it.chain(queue, ent)
+                profiler.count('ranges expanded')
+                ranges.append(ent)
             else:
+                profiler.count('ranges truncated')
                 # unroll ends only
                 ent = tuple(ent)
                 k = unroll_max // 2
-                queue = it.chain(queue, ent[:k])
-                queue = it.chain(queue, ent[-k:])
-        elif ent.address() not in registered:
+                ranges.append(ent[:k])
+                ranges.append(ent[len(ent)-k:])
+        else:
+            yield ent
+    yield from ranges
+
+
+def unrolled(universe, unrollp, unroll_max):
+    '''
+    unrolled() instantiates a generator of the individual records
+    `exclusion()` tests against the registered set, in the order it tests
+    them.
+    '''
+    for ent in queued(universe, unrollp, unroll_max):
+        if hasattr(ent, '__iter__'):
+            yield from ent
+        else:
             yield ent
 
 
+def exclusion(universe, registered, unrollp, unroll_max, distance=0,
+              report=None, confidence=MIN_CONFIDENCE):
+    '''
+    exclusion() instantiates a generator of the records of the universe
+    whose addresses aren't in the registered set of `StreetAddress`es. Given
+    an edit `distance`, records with a near-miss registered address, matched
+    with at least the given `confidence`, are dropped as well; see
+    `fuzzy.unmatched()`.
+    '''
+    if distance > 0:
+        registered = set(registered)
+        matcher = NearMatcher(RegisteredIndex.build(registered), distance,
+                              confidence)
+        yield from unmatched(exclusion(universe, registered, unrollp,
+                                       unroll_max), matcher, report)
+        return
+    universe = unrolled(universe, unrollp, unroll_max)
+    for ent in instrument.profiler.timed('unroll', universe):
+        if ent.address() not in registered:
+            yield ent
+
+
+def absent(index: RegisteredIndex, rng: AddressRange):
+    '''
+    absent() instantiates a generator of the members of an address range
+    that aren't registered, looking up the registered house numbers of its
+    street within its bounds instead of testing each member in turn.
+    '''
+    numbers = rng.numbers()
+    if not numbers:
+        return
+    codec = index.codec
+    doubled = [int(2 * n) for n in numbers]
+    if max(doubled) >= codec.NUMBER_SPLIT:
+        # too large to encode arithmetically; test members one by one
+        members = [rng.member(n) for n in numbers]
+        keys = codec.lookup_records(members)
+        for i in np.flatnonzero(~index.contains(keys)):
+            yield members[i]
+        return
+    ids = codec.known(rng.ent.par_zip, rng.ent.gis_st_name)
+    reg = set()
+    if ids is not None:
+        reg = set(index.numbers(*ids, min(doubled), max(doubled)).tolist())
+    for n, n2 in zip(numbers, doubled):
+        if n2 not in reg:
+            yield rng.member(n)
+
+
+def excluded(queue, index: RegisteredIndex):
+    '''
+    excluded() instantiates a generator of `(i, record)` pairs for each
+    record of the items of a queue built by `queued()` whose address isn't
+    registered in the given index, where `i` is the position of the item the
+    record came from. Addresses are only looked up in the index's codec,
+    not added to it, so several threads may share the index.
+    '''
+    singles = [i for i, ent in enumerate(queue)
+               if not hasattr(ent, '__iter__')]
+    ends = [x for ent in queue if isinstance(ent, tuple) for x in ent]
+    # test singles and truncated range ends in one pass
+    U = index.codec.lookup_records(
+        it.chain((queue[i] for i in singles), ends))
+    mask = ~index.contains(U)
+    for k in np.flatnonzero(mask[:len(singles)]):
+        yield singles[k], queue[singles[k]]
+    mask = iter(mask[len(singles):])
+    for i, ent in enumerate(queue):
+        if isinstance(ent, AddressRange):
+            for x in absent(index, ent):
+                yield i, x
+        elif isinstance(ent, tuple):
+            for x in ent:
+                if next(mask):
+                    yield i, x
+
+
+def vexclusion(universe, registered, unrollp, unroll_max, distance=0,
+               report=None, matcher=None, confidence=MIN_CONFIDENCE):
+    '''
+    vexclusion() yields the same records as `exclusion()`, but encodes both
+    address sets into int64 keys and computes the anti-join in a single
+    vectorized pass; `registered` may be a `RegisteredIndex` or an iterable
+    of `StreetAddress`es. Address ranges are matched against the registered
+    house numbers of their street without being unrolled. A `NearMatcher`
+    of `registered` may be given to reuse across calls instead of building
+    one for the edit `distance` and `confidence`.
+    '''
+    if not isinstance(registered, RegisteredIndex):
+        registered = RegisteredIndex.build(registered)
+    queue = list(instrument.profiler.timed(
+        'unroll', queued(universe, unrollp, unroll_max)))
+    X = (ent for _, ent in excluded(queue, registered))
+    if matcher is None and distance > 0:
+        matcher = NearMatcher(registered, distance, confidence)
+    if matcher is not None:
+        X = unmatched(X, matcher, report)
+    yield from X
+
+
+def rowsAt(istrm, offsets):
+    '''
+    rowsAt() instantiates a generator of `(offset, row)` pairs of the rows
+    of a binary CSV stream starting at each of the given byte offsets, in
+    ascending order, so that a compressed stream, which can only seek by
+    reading on, is read through at most once
+    '''
+    for offset in sorted(offsets):
+        istrm.seek(offset)
+        yield offset, next(csv.reader(line.decode('utf-8') for line in istrm))
+
+
+def universeIndex(path, unrollp, unroll_max):
+    '''
+    build a `UniverseIndex` of the parcel roll at the given path, reading
+    only the fields addresses are encoded from into a `RecordStore`, along
+    with the byte offset of each row. Single addresses are encoded a column
+    at a time; only parcels that might be ranges are looked at one by one.
+    '''
+    codec = AddressCodec()
+    fields = ('par_zip', 'gis_st_name', 'st_nbr')
+    store = parcelStore(path, fields=fields, offsets=True)
+    maybe = np.flatnonzero(store.columns['st_nbr'].contains(RANGECHARS))
+    singles = [np.setdiff1d(np.arange(len(store)), maybe, assume_unique=True)]
+    ranges = []
+    for row, ent in zip(maybe.tolist(), storeRecords(store, maybe)):
+        if hasattr(ent, '__iter__'):
+            ranges.append((row, ent))
+        else:
+            singles.append([row])
+    # (keys, rows, parts) of singles, in row order, then of range members
+    if unrollp:
+        singles = np.empty(0, dtype=np.int64)
+    else:
+        singles = np.sort(np.concatenate(singles).astype(np.int64))
+    keys = [ingest.addressKeys(codec, *(pd.Series(store.columns[f].take(
+        singles), dtype=object) for f in fields))]
+    rows, parts = [singles], [np.zeros(len(singles), dtype=np.int64)]
+    for row, ent in ranges:
+        # the house numbers of the members `unrolled()` yields
+        numbers = ent.numbers()
+        if 0 <= unroll_max < len(numbers):
+            k = unroll_max // 2
+            numbers = numbers[:k] + numbers[len(numbers)-k:]
+        doubled = [2 * n for n in numbers]
+        if all(d == int(d) and 0 <= d < codec.NUMBER_SPLIT for d in doubled):
+            # members in canonical form differ only in their house numbers
+            base = codec.pack(codec.city(ent.ent.par_zip),
+                              codec.rawstreet(ent.ent.gis_st_name), 0)
+            keys.append(base | np.array(doubled, dtype=np.int64))
+        else:
+            keys.append(codec.encode_records(ent.member(n) for n in numbers))
+        rows.append(np.full(len(numbers), row, dtype=np.int64))
+        parts.append(np.arange(len(numbers), dtype=np.int64))
+    rows = np.concatenate(rows)
+    return UniverseIndex(codec, np.concatenate(keys), store.offsets[rows],
+                         np.concatenate(parts), source=fingerprint(path),
+                         options=[unrollp, unroll_max])
+
+
+def open_universe(path, source, unrollp, unroll_max):
+    '''
+    open_universe() loads the `UniverseIndex` saved at the given path,
+    (re)building it from the parcel roll `source` first if it doesn't exist,
+    is stale, or was built with other unrolling options
+    '''
+    options = [unrollp, unroll_max]
+    if os.path.exists(path):
+        index = UniverseIndex.load(path)
+        if not index.stale(source, options):
+            return index
+    universeIndex(source, unrollp, unroll_max).save(path)
+    return UniverseIndex.load(path)
+
+
+def excludedMask(index: UniverseIndex, old) -> np.ndarray:
+    '''
+    boolean mask of the records of `index` that `vexclusion()` yields of the
+    parcel roll it was built from, given the registered address keys `old`,
+    encoded with `index.codec`
+    '''
+    return ~RegisteredIndex(index.codec, np.unique(old)).contains(index.keys)
+
+
+def patched(previous, universe, index: UniverseIndex, old, new,
+            excluded=None):
+    '''
+    patched() instantiates a generator of the rows `vexclusion()` yields the
+    records of, given the registered address keys `new`, from the rows
+    `previous` it yielded given `old`: rows of newly registered addresses
+    are dropped, and rows of newly unregistered ones are read from the
+    parcel roll `universe` (a binary stream, decompressed if need be; see
+    `ingest.opened()`) and spliced in where they belong. Only the records
+    of addresses in the symmetric difference of `old` and `new` are looked
+    up; both must be encoded with `index.codec`. The `excludedMask()` of
+    `index` and `old` may be given if already at hand.
+    '''
+    old = np.unique(old)
+    new = np.unique(new)
+    registered = np.setdiff1d(new, old, assume_unique=True)
+    unregistered = np.setdiff1d(old, new, assume_unique=True)
+    unrollp, unroll_max = index.options
+    if excluded is None:
+        excluded = excludedMask(index, old)
+    # excluded records tested before each position, given `old`
+    before = np.cumsum(excluded) - excluded
+    drops = set(before[index.positions(registered)].tolist())
+    adds = index.positions(unregistered)
+    ranks = before[adds].tolist()
+    offsets = np.unique(index.offsets[adds]).tolist()
+    adds = adds.tolist()
+    instrument.profiler.count('newly registered records', len(drops))
+    instrument.profiler.count('newly unregistered records', len(adds))
+
+    # read the rows of the records to splice in up front, in the order
+    # they're found in the roll
+    members = {}
+    for offset, row in rowsAt(universe, offsets):
+        members[offset] = list(unrolled((addressRecord(row),), unrollp,
+                                        unroll_max))
+
+    def fetch(i):
+        return members[int(index.offsets[i])][index.parts[i]].tuple()
+
+    k = 0
+    n = 0
+    for row in previous:
+        while k < len(adds) and ranks[k] == n:
+            yield fetch(adds[k])
+            k += 1
+        if n not in drops:
+            yield row
+        n += 1
+    for i in adds[k:]:
+        yield fetch(i)
+    if n != excluded.sum():
+        raise ValueError(f'previous output has {n} rows, but'
+                         f' {excluded.sum()} records were excluded given'
+                         ' the previous registrations')
+
+
+def shards(zips, n: int) -> dict:
+    '''
+    shards() assigns each ZIP of a parcel roll's `CategoricalColumn` of them
+    to one of `n` shards, largest first, each to the shard with the fewest
+    parcels so far, so that shards come out about the same size
+    '''
+    counts = np.bincount(zips.codes, minlength=len(zips.labels)).tolist()
+    loads = [(0, k) for k in range(n)]
+    assigned = {}
+    for count, zip_ in sorted(zip(counts, zips.labels),
+                              key=lambda x: (-x[0], x[1])):
+        load, k = heapq.heappop(loads)
+        assigned[zip_] = k
+        heapq.heappush(loads, (load + count, k))
+    return assigned
+
+
+# the fields of the parcels of a shard its worker compares addresses on
+SHARD_FIELDS = ('st_nbr', 'gis_st_name', 'par_zip')
+
+
+def _exclude_shard(job):
+    columns, rows, index, unrollp, unroll_max, profiling = job
+    if profiling:
+        instrument.enable()
+    store = RecordStore(columns, ParcelView)
+    # order the shard's queue the way `queued()` orders the whole universe,
+    # tagging each item with (phase, row, part) so shards can be merged
+    tags = []
+    queue = []
+    for i, ent in zip(rows.tolist(), storeRecords(store)):
+        phase = int(hasattr(ent, '__iter__'))
+        for part, item in enumerate(queued((ent,), unrollp, unroll_max)):
+            tags.append((phase, i, part))
+            queue.append(item)
+    order = sorted(range(len(queue)), key=tags.__getitem__)
+    tags = [tags[i] for i in order]
+    queue = [queue[i] for i in order]
+    # send back where each record comes from, and the house number of those
+    # unrolled from ranges, rather than the records themselves
+    found = [(tags[i], None if x.overrides is None else x.st_nbr)
+             for i, x in excluded(queue, index)]
+    # stage times overlap between workers, so only report counters
+    counters = dict(instrument.profiler.counters) if profiling else {}
+    return found, counters
+
+
+def sharded(store, index: RegisteredIndex, unrollp, unroll_max, workers):
+    '''
+    sharded() yields the same records as `vexclusion()` of the parcels of a
+    `RecordStore`, by partitioning them by ZIP and the keys of the
+    registered addresses of `index` by city (the fields `StreetAddress`es
+    compare them on), see `shards()`, and running `excluded()` on each shard
+    in a pool of worker processes. Both are only read once, by this
+    process; each worker is sent the address columns of its own parcels and
+    the keys of its own registered addresses, and only sends back the
+    positions of the records it excludes.
+    '''
+    profiler = instrument.profiler
+    zips = store.columns['par_zip']
+    assigned = shards(zips, workers)
+    shard = np.array([assigned[z] for z in zips.labels],
+                     dtype=np.int64)[zips.codes]
+    cities = np.array([assigned.get(c, -1) for c in index.codec.cities],
+                      dtype=np.int64)
+    keys = np.asarray(index.keys)
+    regshard = cities[keys >> AddressCodec.CITY_SHIFT]
+    jobs = []
+    for k in range(workers):
+        rows = np.flatnonzero(shard == k)
+        columns = {f: store.columns[f].select(rows) for f in SHARD_FIELDS}
+        jobs.append((columns, rows,
+                     RegisteredIndex(index.codec, keys[regshard == k]),
+                     unrollp, unroll_max, profiler.enabled))
+    with Pool(workers) as pool:
+        results = pool.map(_exclude_shard, jobs)
+    for _, counters in results:
+        for name, n in counters.items():
+            profiler.count(name, n)
+    results = [found for found, _ in results]
+    view = store.view
+    for (_, row, _), nr in heapq.merge(*results, key=lambda x: x[0]):
+        ent = view(store, row)
+        yield ent if nr is None else ent.derive(st_nbr=nr)
+
+
 if __name__ == '__main__':
     from argparse import ArgumentParser
     parser = ArgumentParser('obtain mailing list of unregistered voters')
@@ -53,7 +430,13 @@ if __name__ == '__main__':
                         required=True)
     parser.add_argument('--registered',
                         help='path from which to read registrant address set',
-                        required=True)
+                        default=None)
+    parser.add_argument('--registered-index',
+                        help=('path of a registered address index to use'
+                              ' instead of parsing --registered; it is built'
+                              ' or rebuilt from --registered if missing or'
+                              ' stale'),
+                        default=None)
     parser.add_argument('--opath',
                         help='output path',
                         default=None)
@@ -62,30 +445,194 @@ if __name__ == '__main__':
                         action='store_true')
     parser.add_argument('--unrollmax',
                         type=int,
-                        help='max. number of addresses to unroll',
-                        default=3)
+                        help=('max. number of addresses to unroll per range;'
+                              ' longer ranges are truncated to their ends'
+                              ' (default: no limit)'),
+                        default=-1)
+    parser.add_argument('--engine',
+                        help=('anti-join implementation; "generator" tests'
+                              ' each address against a set of'
+                              ' `StreetAddress`es'),
+                        choices=('vectorized', 'generator'),
+                        default='vectorized')
+    parser.add_argument('--workers',
+                        type=int,
+                        help=('number of processes among which to shard the'
+                              ' vectorized engine\'s work by ZIP'),
+                        default=1)
+    parser.add_argument('--previous',
+                        help=('path of the output of a previous run; if'
+                              ' given, it is patched to reflect the changes'
+                              ' between --previous-registered and'
+                              ' --registered instead of recomputing it'),
+                        default=None)
+    parser.add_argument('--previous-registered',
+                        help=('registrant address set --previous was made'
+                              ' from, or a registered address index of it'),
+                        default=None)
+    parser.add_argument('--universe-index',
+                        help=('path of an index of --universe for'
+                              ' --previous to use; it is built or rebuilt if'
+                              ' missing or stale'),
+                        default=None)
+    parser.add_argument('--fuzzy',
+                        type=int,
+                        help=('max. edit distance between the normalized'
+                              ' street names of a parcel and a registered'
+                              ' address with the same city and house number'
+                              ' for the parcel to count as registered'
+                              ' (default: exact matches only)'),
+                        default=0)
+    parser.add_argument('--fuzzy-confidence',
+                        type=float,
+                        help=('min. confidence of a match by --fuzzy, i.e.'
+                              ' the share of the longer street name left'
+                              ' unedited, for the parcel to count as'
+                              f' registered (default: {MIN_CONFIDENCE})'),
+                        default=MIN_CONFIDENCE)
+    parser.add_argument('--fuzzy-report',
+                        help=('path to which to write each parcel matched'
+                              ' by --fuzzy, along with the registered street'
+                              ' it matched and the confidence of the match'),
+                        default=None)
+    output.add_arguments(parser)
+    instrument.add_argument(parser)
     args = parser.parse_args()
+    output.check_arguments(parser, args)
+    if args.fuzzy > 0 and (args.workers > 1 or args.previous is not None):
+        parser.error('--fuzzy can\'t be combined with --workers or'
+                     ' --previous')
+    if args.fuzzy_report is not None and args.fuzzy <= 0:
+        parser.error('--fuzzy-report requires --fuzzy')
+    if not 0 <= args.fuzzy_confidence <= 1:
+        parser.error('--fuzzy-confidence must be between 0 and 1')
+    if args.previous is not None:
+        if args.previous_registered is None:
+            parser.error('--previous requires --previous-registered')
+        if args.workers > 1 or args.engine == 'generator':
+            parser.error('--previous requires the single-process vectorized'
+                         ' engine')
+        if args.opath is not None and os.path.exists(args.opath) \
+                and os.path.samefile(args.opath, args.previous):
+            parser.error('--opath must differ from --previous')
+    if args.registered is None and args.registered_index is None:
+        parser.error('one of --registered or --registered-index is required')
+    if args.registered_index is not None and args.engine == 'generator':
+        parser.error('--registered-index requires the vectorized engine')
+    if args.workers > 1 and args.engine == 'generator':
+        parser.error('--workers requires the vectorized engine')
+    if args.profile is not None:
+        instrument.enable()
+    profiler = instrument.profiler
     # Instantiate a generator to read in the solution set of addresses
-    istrm = open(args.universe)
-    U = addressRecords(istrm)
-    header = list(next(U))
-    header.append('CANON')
-
-    istrm = open(args.registered)
-    R = set(registered(istrm))
-    X = exclusion(U, R, args.unroll, args.unrollmax)
-
-    if args.opath is None:
-        from sys import stdout
-        ostrm = stdout
+    if args.previous is not None:
+        U = None
+    elif args.engine == 'generator':
+        U = addressRecords(io.TextIOWrapper(ingest.opened(args.universe),
+                                            encoding='utf-8', newline=''))
+        header = list(next(U))
+        U = profiler.timed('read', U)
+    else:
+        # hold the parcel roll column-wise rather than as one object per row
+        with profiler.stage('read') as stage:
+            store = parcelStore(args.universe)
+            stage.rows += len(store)
+        U = storeRecords(store)
+        header = ingest.header(args.universe)
+    if args.previous is None:
+        header.append('CANON')
+
+    report = None
+    if args.fuzzy_report is not None:
+        rstrm = open(args.fuzzy_report, 'w')
+        reporter = csv.writer(rstrm)
+        reporter.writerow(header + ['REGISTERED_STREET', 'DISTANCE',
+                                    'CONFIDENCE'])
+        report = lambda ent, street, d, confidence: reporter.writerow(
+            (*ent.tuple(), street, d, f'{confidence:.3f}'))
+
+    if args.previous is not None:
+        with profiler.stage('read'):
+            if args.universe_index is not None:
+                index = open_universe(args.universe_index, args.universe,
+                                      args.unroll, args.unrollmax)
+            else:
+                index = universeIndex(args.universe, args.unroll,
+                                      args.unrollmax)
+            if is_index(args.previous_registered):
+                old = RegisteredIndex.load(args.previous_registered)
+                old = old.recoded(index.codec)
+            else:
+                old = ingest.registeredKeys(args.previous_registered,
+                                            index.codec)
+            if args.registered_index is not None:
+                new = open_index(args.registered_index, args.registered)
+                new = new.recoded(index.codec)
+            else:
+                new = ingest.registeredKeys(args.registered, index.codec)
+            # check the previous output before --opath is opened, so that
+            # a mismatch doesn't leave it half written
+            n = ingest.rowCount(args.previous)
+            excluded = excludedMask(index, old)
+            expected = int(excluded.sum())
+        if n != expected:
+            parser.error(f'--previous has {n} rows, but {expected} records'
+                         ' were excluded given --previous-registered')
+        if args.previous.endswith('.gz'):
+            previous = gzip.open(args.previous, 'rt', newline='')
+        else:
+            previous = open(args.previous, newline='')
+        previous = csv.reader(previous)
+        header = next(previous)
+        X = patched(previous, ingest.opened(args.universe), index, old,
+                    new, excluded)
+    elif args.registered_index is not None:
+        with profiler.stage('read'):
+            R = open_index(args.registered_index, args.registered)
+        if args.workers > 1:
+            X = sharded(store, R, args.unroll, args.unrollmax, args.workers)
+        else:
+            X = vexclusion(U, R, args.unroll, args.unrollmax, args.fuzzy,
+                           report, confidence=args.fuzzy_confidence)
+    elif args.engine == 'generator':
+        istrm = io.TextIOWrapper(ingest.opened(args.registered),
+                                 encoding='utf-8', newline='')
+        R = set(profiler.timed('read', registered(istrm)))
+        X = exclusion(U, R, args.unroll, args.unrollmax, args.fuzzy, report,
+                      args.fuzzy_confidence)
+    elif args.workers > 1:
+        with profiler.stage('read'):
+            R = RegisteredIndex.fromcsv(args.registered)
+        X = sharded(store, R, args.unroll, args.unrollmax, args.workers)
+    else:
+        with profiler.stage('read'):
+            R = RegisteredIndex.fromcsv(args.registered)
+        X = vexclusion(U, R, args.unroll, args.unrollmax, args.fuzzy, report,
+                       confidence=args.fuzzy_confidence)
+    X = profiler.timed('join', X)
+    if args.previous is None:
+        X = output.tabulated(X)
     else:
-        ostrm = open(args.opath, 'w')
+        X = output.batched(X)
 
-    stenographer = csv.writer(ostrm)
+    try:
+        ostrm = output.open_writer(args.opath, header, args.format,
+                                   args.split_by)
+    except ValueError as e:
+        parser.error(str(e))
 
     try:
-        stenographer.writerow(header)
-        for ent in X:
-            stenographer.writerow(ent.tuple())
+        with profiler.stage('write') as stage:
+            for rows in X:
+                ostrm.write(rows)
+                stage.rows += len(rows)
     finally:
         ostrm.close()
+        if args.fuzzy_report is not None:
+            rstrm.close()
+    if args.profile is not None:
+        normalizer = StreetAddress.normalizer
+        if normalizer.misses:
+            profiler.count('normalize cache hits', normalizer.hits)
+            profiler.count('normalize cache misses', normalizer.misses)
+        profiler.dump(args.profile)
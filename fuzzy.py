@@ -0,0 +1,229 @@
+import itertools as it
+import threading
+from math import floor
+import numpy as np
+from common import ABBV, AddressCodec, StreetAddress
+from addrindex import RegisteredIndex
+import instrument
+
+STREET_BITS = AddressCodec.CITY_SHIFT - AddressCodec.STREET_SHIFT
+STREET_MASK = (1 << STREET_BITS) - 1
+# designators as `StreetAddress.canonicalize` spells them: directions are
+# prepended to the first word, street types abbreviated
+DIRECTIONS = sorted(set(StreetAddress._cardinal.values()), key=len,
+                    reverse=True)
+QUALIFIERS = frozenset(ABBV.values())
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+# least confidence of a near miss, i.e. the share of the longer of two names
+# left unedited, for it to count; an absolute edit distance alone lets short
+# names match nearly anything, e.g. 'bay ln' and 'oak ln'
+MIN_CONFIDENCE = 0.75
+
+
+def bigrams(s: str) -> frozenset:
+    return frozenset(s[i:i+2] for i in range(len(s) - 1))
+
+
+def signature(s: str) -> int:
+    '''
+    64-bit set of the hashes of the bigrams of a string; a bigram of one
+    string missing from another has its bit unset in the other's signature
+    unless another of its bigrams hashes to the same bit
+    '''
+    sig = 0
+    for gram in bigrams(s):
+        sig |= 1 << (hash(gram) & 63)
+    return sig
+
+
+def popcount(x: np.ndarray) -> np.ndarray:
+    x = np.ascontiguousarray(x, dtype=np.uint64)
+    return POPCOUNT[x.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def direction(street: str) -> str:
+    return next((d for d in DIRECTIONS if street.startswith(d)), '')
+
+
+def distinct(a: str, b: str) -> bool:
+    '''
+    whether two normalized street names spell out different designators,
+    i.e. directions or street types, in the same place; e.g. 'park ct' and
+    'park st' name different streets, however alike they look
+    '''
+    da, db = direction(a), direction(b)
+    if da and db and da != db:
+        return True
+    return any(x != y and x in QUALIFIERS and y in QUALIFIERS
+               for x, y in zip(a.split(' ')[1:], b.split(' ')[1:]))
+
+
+def levenshtein(a: str, b: str, bound: int) -> int:
+    '''
+    levenshtein() computes the edit distance between two strings, giving up
+    with `bound + 1` as soon as it must exceed `bound`
+    '''
+    if abs(len(a) - len(b)) > bound:
+        return bound + 1
+    # only the cores between a common prefix and suffix need comparing
+    i = 0
+    n = min(len(a), len(b))
+    while i < n and a[i] == b[i]:
+        i += 1
+    j = 0
+    while j < n - i and a[-1-j] == b[-1-j]:
+        j += 1
+    a, b = a[i:len(a)-j], b[i:len(b)-j]
+    if len(a) < len(b):
+        a, b = b, a
+    big = bound + 1
+    if not b:
+        return min(len(a), big)
+    # only cells within `bound` of the diagonal can be within `bound`
+    n = len(b)
+    prev = [j if j <= bound else big for j in range(n + 1)]
+    for i, ca in enumerate(a, 1):
+        lo = max(1, i - bound)
+        hi = min(n, i + bound)
+        cur = [big] * (n + 1)
+        cur[0] = i if i <= bound else big
+        for j in range(lo, hi + 1):
+            x = prev[j-1] + (ca != b[j-1])
+            y = prev[j] + 1
+            if y < x:
+                x = y
+            y = cur[j-1] + 1
+            if y < x:
+                x = y
+            cur[j] = x
+        if min(cur[lo-1:hi+1]) > bound:
+            return big
+        prev = cur
+    return min(prev[n], big)
+
+
+class NearMatcher(object):
+    '''
+    find registered addresses whose normalized street names are within a
+    given edit distance of those of other addresses, only comparing
+    addresses within the same block: the same city and house number. Blocks
+    are read straight off the keys of a `RegisteredIndex` by masking out
+    their street ids. Candidates are screened a batch at a time by the
+    lengths and bigram signatures of their names, and only the rest have
+    their distance computed. Streets that differ in a designator both spell
+    out never match; see `distinct()`, and neither do those whose match
+    would have less than the given `confidence`; see `nearest()`. Matching
+    adds the streets of the addresses matched to the index's codec, so
+    threads sharing a matcher take turns on its `lock`.
+    '''
+    def __init__(self, index: RegisteredIndex, distance: int,
+                 confidence: float = MIN_CONFIDENCE):
+        self.codec = index.codec
+        self.distance = distance
+        self.confidence = confidence
+        self.mask = ~(STREET_MASK << AddressCodec.STREET_SHIFT)
+        keys = np.asarray(index.keys, dtype=np.int64)
+        blocks = keys & np.int64(self.mask)
+        order = np.argsort(blocks, kind='stable')
+        self.blocks = blocks[order]
+        self.streets = ((keys[order] >> AddressCodec.STREET_SHIFT)
+                        & STREET_MASK)
+        # names, lengths and signatures of streets, by id
+        self.names = []
+        self.lengths = np.empty(0, dtype=np.int64)
+        self.signatures = np.empty(0, dtype=np.uint64)
+        self.lock = threading.Lock()
+        self.grow()
+
+    def grow(self):
+        'catch up with streets added to the codec since'
+        names = list(self.codec.streets)
+        new = names[len(self.names):]
+        if not new:
+            return
+        self.names = names
+        self.lengths = np.concatenate([
+            self.lengths, np.fromiter(map(len, new), dtype=np.int64,
+                                      count=len(new))])
+        self.signatures = np.concatenate([
+            self.signatures, np.fromiter(map(signature, new),
+                                         dtype=np.uint64, count=len(new))])
+
+    def candidates(self, keys: np.ndarray):
+        '''
+        pairs of positions into `keys` and ids of registered streets in the
+        same block whose names might be within the edit distance of theirs
+        '''
+        self.grow()
+        blocks = keys & np.int64(self.mask)
+        lo = np.searchsorted(self.blocks, blocks, side='left')
+        hi = np.searchsorted(self.blocks, blocks, side='right')
+        counts = hi - lo
+        which = np.repeat(np.arange(len(keys)), counts)
+        pos = (np.arange(counts.sum())
+               + np.repeat(lo - np.cumsum(counts) + counts, counts))
+        street = (keys >> AddressCodec.STREET_SHIFT) & STREET_MASK
+        own = street[which]
+        other = self.streets[pos]
+        d = self.distance
+        ok = ((own != other)
+              & (np.abs(self.lengths[own] - self.lengths[other]) <= d))
+        which, own, other = which[ok], own[ok], other[ok]
+        # an edit destroys at most two of a string's bigrams
+        a, b = self.signatures[own], self.signatures[other]
+        ok = (popcount(a & ~b) <= 2 * d) & (popcount(b & ~a) <= 2 * d)
+        return which[ok], other[ok]
+
+    def nearest(self, keys: np.ndarray):
+        '''
+        the closest registered street in the block of each given key to its
+        own, as `(street, distance, confidence)`, or None if none is within
+        the edit distance with at least the matcher's confidence, that is
+        `1 - distance / max(len(street), len(own))`; ties go to the first in
+        alphabetical order
+        '''
+        matches = [None] * len(keys)
+        which, other = self.candidates(keys)
+        streets = (keys >> AddressCodec.STREET_SHIFT) & STREET_MASK
+        streets = streets.tolist()
+        for i, o in zip(which.tolist(), other.tolist()):
+            name, candidate = self.names[streets[i]], self.names[o]
+            best = matches[i]
+            bound = self.distance if best is None else best[1]
+            longest = max(len(name), len(candidate))
+            # the most edits leaving the confidence required
+            bound = min(bound, floor((1 - self.confidence) * longest + 1e-9))
+            d = levenshtein(name, candidate, bound)
+            if d > bound or distinct(name, candidate):
+                continue
+            if best is None or (d, candidate) < (best[1], best[0]):
+                matches[i] = (candidate, d, 1 - d / longest)
+        return matches
+
+
+def unmatched(records, matcher: NearMatcher, report=None, batch=1 << 12):
+    '''
+    unmatched() instantiates a generator of the given records that
+    `matcher` finds no near-miss registered address for, in order. Given
+    `report`, it's called with each other record, the registered street it
+    matched, their edit distance and the confidence of the match.
+    '''
+    profiler = instrument.profiler
+    records = iter(records)
+    while True:
+        chunk = list(it.islice(records, batch))
+        if not chunk:
+            return
+        with profiler.stage('fuzzy') as stage:
+            with matcher.lock:
+                matches = matcher.nearest(matcher.codec.encode_records(chunk))
+            keep = []
+            for ent, match in zip(chunk, matches):
+                if match is None:
+                    keep.append(ent)
+                    continue
+                profiler.count('fuzzy matches')
+                if report is not None:
+                    report(ent, *match)
+            stage.rows += len(chunk)
+        yield from keep
@@ -1,78 +1,294 @@
-import csv
+import asyncio
 import json
+import sqlite3
+from collections import deque
 # import pdb
 from xml.etree import ElementTree
-from aiohttp import ClientSession as HTTP
-from exclusion import MonroeCtRecord
+from aiohttp import (ClientError, ClientSession as HTTP, ClientTimeout,
+                     TCPConnector)
+from common import MonroeCtRecord, StreetAddress, addressRecords
+from exclusion import unrolled
+import instrument
+import output
 
+ENDPOINT = 'https://geocoder.api.here.com/6.2/geocode.json'
+# responses worth retrying: rate limiting and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# seconds a request may take in all before it's retried
+TIMEOUT = 30
 
-async def is_valid(http: HTTP, hereIdent: str, hereKey: str, addr: MonroeCtRecord):
+
+def judge(body: bytes) -> bool:
+    # Verify the HERE API's confidence in its response
+    # https://developer.here.com/documentation/geocoder/topics/quick-start-geocode.html
+    try:
+        payload = json.loads(body)['Response']
+        result = payload['View'][0]['Result'][0]
+        if result['MatchLevel'] != 'houseNumber':
+            return False
+        if result['Relevance'] != 1:
+            return False
+        return True
+    except Exception:
+        return False
+
+
+def complaint(body: bytes) -> str:
+    try:
+        root = ElementTree.fromstring(body)
+        kind = root.attrib['type'] + '/' + root.attrib['subtype']
+        desc = root[0].text
+        return f'{kind}: {desc}'
+    except Exception:
+        return body.decode('utf-8', 'replace')
+
+
+class RateLimiter(object):
+    '''
+    space the starts of successive requests at least 1/rate seconds apart
+    '''
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self.next = 0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            if self.next > now:
+                await asyncio.sleep(self.next - now)
+                now = self.next
+            self.next = now + self.interval
+
+
+class ResultCache(object):
+    '''
+    persistent store of validation results keyed by the canonical
+    `StreetAddress.tuple()` of each address, so that re-runs only query
+    addresses they haven't seen before
+    '''
+    # commit after this many new results, so interrupted runs keep theirs
+    BATCH = 1000
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.uncommitted = 0
+        self.db.execute('CREATE TABLE IF NOT EXISTS results ('
+                        ' city TEXT, street TEXT, number TEXT, valid INTEGER,'
+                        ' PRIMARY KEY (city, street, number))')
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, addr: StreetAddress):
+        row = self.db.execute('SELECT valid FROM results WHERE city = ? AND'
+                              ' street = ? AND number = ?',
+                              addr.tuple()).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return bool(row[0])
+
+    def put(self, addr: StreetAddress, valid: bool):
+        self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)',
+                        (*addr.tuple(), int(valid)))
+        self.uncommitted += 1
+        if self.uncommitted >= self.BATCH:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+async def is_valid(http: HTTP, hereIdent: str, hereKey: str,
+                   addr: MonroeCtRecord, endpoint=ENDPOINT, retries=5,
+                   backoff=0.5, limiter: RateLimiter = None):
     query = {'app_id': hereIdent, 'app_code': hereKey, 'searchtext': str(addr)}
-    async with http.get('https://geocoder.api.here.com/6.2/geocode.json',
-            params=query) as rsp:
-        # Verify the HERE API's confidence in its response and whether it threw any errors
-        # https://developer.here.com/documentation/geocoder/topics/quick-start-geocode.html
-        body = await rsp.read()
-        if rsp.status != 200:
-            root = ElementTree.fromstring(body)
-            kind = root.attrib['type'] + '/' + root.attrib['subtype']
-            desc = root[0].text
-            raise ValueError('HERE API: {kind}: {desc}')
+    profiler = instrument.profiler
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            await limiter.wait()
+        profiler.count('requests')
         try:
-            payload = json.loads(body)['Response']
-            result = payload['View'][0]['Result'][0]
-            if result['MatchLevel'] != 'houseNumber':
-                return False
-            if result['Relevance'] != 1:
-                return False
-            return True
-        except Exception:
-            return False
+            async with http.get(endpoint, params=query) as rsp:
+                body = await rsp.read()
+                status = rsp.status
+                delay = rsp.headers.get('Retry-After')
+        except (ClientError, asyncio.TimeoutError):
+            # dropped connections and timeouts are as transient as a 503
+            if attempt == retries:
+                raise
+            profiler.count('retries')
+            await asyncio.sleep(backoff * 2 ** attempt)
+            continue
+        if status == 200:
+            return judge(body)
+        if status not in RETRY_STATUSES or attempt == retries:
+            raise ValueError(f'HERE API: {status}: {complaint(body)}')
+        try:
+            delay = float(delay)
+        except (TypeError, ValueError):
+            delay = backoff * 2 ** attempt
+        profiler.count('retries')
+        await asyncio.sleep(delay)
 
 
-def valid(universe, hereIdent, hereKey):
-    universe = tuple(universe)
-    with HTTP() as http:
-        jobs = (is_valid(http, hereIdent, hereKey, ent) for ent in universe)
-        valid = asyncio.run_until_complete(asyncio.gather(*jobs))
+async def validate(universe, hereIdent, hereKey, concurrency=16, rate=None,
+                   cache: ResultCache = None, timeout=TIMEOUT, **kwargs):
+    '''
+    validate() instantiates an asynchronous generator of `(ent, valid)` for
+    each record of the universe, in input order, as soon as each resolves.
+    At most `concurrency` requests are in flight and, given a `rate`, at
+    most that many start per second, all over one keep-alive session, and
+    each is retried if it takes more than `timeout` seconds; duplicate
+    addresses are only queried once. Remaining keyword arguments go to
+    `is_valid()`.
+    '''
+    limiter = None if rate is None else RateLimiter(rate)
+    throttle = asyncio.Semaphore(concurrency)
+    inflight = {}
 
-    for i in range(len(universe)):
-        if valid[i]:
-            yield universe[i]
+    async def check(ent):
+        async with throttle:
+            ok = await is_valid(http, hereIdent, hereKey, ent,
+                                limiter=limiter, **kwargs)
+        if cache is not None:
+            cache.put(ent.address(), ok)
+        return ok
+
+    def submit(ent):
+        addr = ent.address()
+        key = addr.tuple()
+        job = inflight.get(key)
+        if job is not None:
+            instrument.profiler.count('duplicate addresses')
+        else:
+            ok = None if cache is None else cache.get(addr)
+            if ok is not None:
+                job = asyncio.get_running_loop().create_future()
+                job.set_result(ok)
+                return job
+            job = inflight[key] = asyncio.ensure_future(check(ent))
+            job.add_done_callback(lambda _: inflight.pop(key, None))
+        return job
+
+    connector = TCPConnector(limit=concurrency, keepalive_timeout=30)
+    async with HTTP(connector=connector,
+                    timeout=ClientTimeout(total=timeout)) as http:
+        # bound the number of records held waiting for their predecessors
+        window = 4 * concurrency
+        pending = deque()
+        try:
+            for ent in universe:
+                pending.append((ent, submit(ent)))
+                while pending and (pending[0][1].done()
+                                   or len(pending) >= window):
+                    ent, job = pending.popleft()
+                    yield ent, await job
+            while pending:
+                ent, job = pending.popleft()
+                yield ent, await job
+        finally:
+            for _, job in pending:
+                job.cancel()
+
+
+def valid(universe, hereIdent, hereKey, **kwargs):
+    '''
+    valid() instantiates a generator of the records of the universe that the
+    HERE API geocodes to a house number with full confidence, streaming them
+    through `validate()`
+    '''
+    loop = asyncio.new_event_loop()
+    results = validate(universe, hereIdent, hereKey, **kwargs)
+    try:
+        while True:
+            try:
+                ent, ok = loop.run_until_complete(results.__anext__())
+            except StopAsyncIteration:
+                break
+            if ok:
+                yield ent
+    finally:
+        loop.run_until_complete(results.aclose())
+        loop.close()
 
 
 if __name__ == '__main__':
     from argparse import ArgumentParser
-    from exclusion import universe
     parser = ArgumentParser('unroll continuous address ranges from a data set')
     parser.add_argument('--ipath', help='input data path', default=None)
     parser.add_argument('--opath', help='output data path', default=None)
     parser.add_argument('--validate', help='if present, validate the input data', action='store_true')
     parser.add_argument('--id', help='HERE API ID', default=None)
     parser.add_argument('--key', help='HERE API Key', default=None)
+    parser.add_argument('--endpoint', help='HERE geocoder endpoint',
+                        default=ENDPOINT)
+    parser.add_argument('--concurrency', type=int,
+                        help='max. number of requests in flight', default=16)
+    parser.add_argument('--rate', type=float,
+                        help='max. number of requests per second',
+                        default=None)
+    parser.add_argument('--retries', type=int,
+                        help='max. number of retries per request', default=5)
+    parser.add_argument('--timeout', type=float,
+                        help='max. seconds per request before retrying it',
+                        default=TIMEOUT)
+    parser.add_argument('--cache',
+                        help='path of a persistent cache of results',
+                        default=None)
+    output.add_arguments(parser)
+    instrument.add_argument(parser)
     args = parser.parse_args()
+    output.check_arguments(parser, args)
+    if args.profile is not None:
+        instrument.enable()
+    profiler = instrument.profiler
     if args.ipath is not None:
         istrm = open(args.ipath)
     else:
         from sys import stdin
         istrm = stdin
 
-    if args.opath is not None:
-        ostrm = open(args.opath, 'w+')
-    else:
-        from sys import stdout
-        ostrm = stdout
-
-    stenographer = csv.writer(ostrm)
-    spool = universe(istrm)
-    stenographer.writerow(next(spool))  # copy header
+    spool = addressRecords(istrm)
+    header = list(next(spool))
+    header.append('CANON')
+    try:
+        ostrm = output.open_writer(args.opath, header, args.format,
+                                   args.split_by)
+    except ValueError as e:
+        parser.error(str(e))
+    spool = profiler.timed('read', spool)
+    spool = profiler.timed('unroll', unrolled(spool, False, -1))
+    cache = None
     if args.validate:
         if args.id is None:
             raise Exception('cmdline: please pass --id to validate addresses')
         if args.key is None:
             raise Exception('cmdline: please pass --key to validaate addresses')
-        spool = valid(spool, args.id, args.key)
-    for ent in spool:
-        stenographer.writerow(ent.tuple())
-
-
+        if args.cache is not None:
+            cache = ResultCache(args.cache)
+        spool = valid(spool, args.id, args.key, concurrency=args.concurrency,
+                      rate=args.rate, cache=cache, endpoint=args.endpoint,
+                      retries=args.retries, timeout=args.timeout)
+        spool = profiler.timed('validate', spool)
+    try:
+        with profiler.stage('write') as stage:
+            for rows in output.tabulated(spool):
+                ostrm.write(rows)
+                stage.rows += len(rows)
+    finally:
+        ostrm.close()
+        if cache is not None:
+            cache.close()
+    if args.profile is not None:
+        normalizer = StreetAddress.normalizer
+        if normalizer.misses:
+            profiler.count('normalize cache hits', normalizer.hits)
+            profiler.count('normalize cache misses', normalizer.misses)
+        if cache is not None:
+            profiler.count('result cache hits', cache.hits)
+            profiler.count('result cache misses', cache.misses)
+        profiler.dump(args.profile)
@@ -0,0 +1,234 @@
+import bz2
+import csv
+import gzip
+import io
+import itertools as it
+import lzma
+import os
+import numpy as np
+import pandas as pd
+import instrument
+from common import AddressCodec, HALFPATTERN, MonroeCtRecord
+
+# columns of the BoE registration file, which leads with the voter id
+BOE_COLUMNS = {
+    'vid': 0,
+    'st_nbr': 5,
+    'street': 6,
+    'city': 11,
+    'zip': 13,
+    'party': 25,
+    'electionDistrict': 29,
+}
+PARCEL_COLUMNS = {k: i for i, k in enumerate(MonroeCtRecord.__slots__)}
+
+
+def header(src):
+    '''
+    the header row of a CSV file, which may be compressed
+    '''
+    row = pd.read_csv(src, header=None, nrows=1, dtype=str, na_filter=False)
+    return row.iloc[0].tolist()
+
+
+# decompressors of the formats `batches()` reads, and the file extensions
+# each is inferred from
+DECOMPRESSORS = {'gzip': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}
+EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz'}
+
+
+def opened(src, compression='infer'):
+    '''
+    a binary stream of the contents of a file or stream, decompressed as
+    it's read if `compression` names one of `DECOMPRESSORS`, or, if 'infer',
+    by the file's extension
+    '''
+    if hasattr(src, 'read'):
+        src = getattr(src, 'buffer', src)
+        if compression == 'infer':
+            compression = None
+    elif compression == 'infer':
+        compression = next((c for e, c in EXTENSIONS.items()
+                            if os.fspath(src).endswith(e)), None)
+    if compression is None:
+        return src if hasattr(src, 'read') else open(src, 'rb')
+    return DECOMPRESSORS[compression](src, 'rb')
+
+
+def lineWidths(block: bytes):
+    '''
+    the number of fields and length in bytes of each line of a block of
+    unquoted CSV, counted from the positions of its line breaks and commas,
+    with 0 fields for blank lines
+    '''
+    buf = np.frombuffer(block, dtype=np.uint8)
+    ends = np.flatnonzero(buf == ord('\n')) + 1
+    if not block.endswith(b'\n'):
+        ends = np.append(ends, len(buf))
+    lengths = np.diff(ends, prepend=0)
+    commas = (buf == ord(',')).view(np.uint8)
+    widths = np.add.reduceat(commas, ends - lengths, dtype=np.uint32)
+    widths = widths.astype(np.int64) + 1
+    for i in np.flatnonzero(lengths <= 2).tolist():
+        if not block[ends[i]-lengths[i]:ends[i]].strip(b'\r\n'):
+            widths[i] = 0
+    return widths, lengths
+
+
+def csvRows(lines, n):
+    '''
+    csvRows() instantiates a generator of the rows of a CSV file parsed from
+    an iterator of its lines, as pairs of their number of fields and the
+    lines they span, up to the row spanning the `n`th line; quoted fields
+    may span lines
+    '''
+    taken = []
+
+    def counted():
+        for line in lines:
+            taken.append(line)
+            yield line.decode('utf-8', 'replace')
+    reader = csv.reader(counted())
+    while n > 0:
+        row = next(reader, None)
+        if row is None:
+            return
+        n -= len(taken)
+        yield len(row), taken
+        taken = []
+
+
+def rowRuns(istrm, blocksize):
+    '''
+    rowRuns() instantiates a generator of runs of whole rows of a binary CSV
+    stream, read about `blocksize` bytes at a time, as triples of their
+    bytes, and the number of fields and length in bytes of each of their
+    rows; blank lines count as rows of no fields
+    '''
+    while True:
+        block = istrm.read(blocksize)
+        if not block:
+            return
+        if not block.endswith(b'\n'):
+            block += istrm.readline()
+        if b'"' not in block:
+            yield (block, *lineWidths(block))
+            continue
+        # quoted fields may hold delimiters and line breaks, so leave them
+        # to the csv module, reading on past the block to the end of its
+        # last row
+        n = block.count(b'\n') + (not block.endswith(b'\n'))
+        rows = list(csvRows(it.chain(io.BytesIO(block), istrm), n))
+        yield (b''.join(line for _, span in rows for line in span),
+               np.fromiter((w for w, _ in rows), dtype=np.int64,
+                           count=len(rows)),
+               np.fromiter((sum(map(len, span)) for _, span in rows),
+                           dtype=np.int64, count=len(rows)))
+
+
+def batches(src, columns, fields, blocksize=1 << 24, compression='infer',
+            offsets=False, header=True):
+    '''
+    batches() instantiates a generator of `pd.DataFrame`s of the rows of
+    about `blocksize` bytes each, holding only the given fields of a headed
+    CSV file or stream, as strings, or of a headless one if not `header`;
+    `columns` maps field names to column positions. Rows too short to hold
+    every field are skipped, and counted as 'short rows'. Compressed input
+    (e.g. '.gz') is decompressed as it's read. Given `offsets`, batches also
+    hold the byte offset at which each row starts in the (decompressed)
+    input, as an 'offset' column.
+    '''
+    positions = [columns[f] for f in fields]
+    need = max(positions) + 1
+    names = {columns[f]: f for f in fields}
+    istrm = opened(src, compression)
+    try:
+        pos = 0
+        if header:
+            # skip the header, however many lines it spans
+            pos = sum(sum(map(len, span))
+                      for _, span in csvRows(iter(istrm.readline, b''), 1))
+        for data, widths, lengths in rowRuns(istrm, blocksize):
+            starts = pos + np.cumsum(lengths) - lengths
+            pos += len(data)
+            # pandas skips blank lines, and pads short rows with the same
+            # empty strings as empty fields, so tell them apart by width
+            starts = starts[widths > 0]
+            widths = widths[widths > 0]
+            short = widths < need
+            if short.any():
+                instrument.profiler.count('short rows', int(short.sum()))
+            if short.all():
+                continue
+            chunk = pd.read_csv(io.BytesIO(data), header=None,
+                                names=range(max(need, widths.max())),
+                                usecols=positions, dtype=str,
+                                na_filter=False, engine='c')
+            chunk = chunk[positions].rename(columns=names)
+            if offsets:
+                chunk['offset'] = starts
+            if short.any():
+                chunk = chunk[~short].reset_index(drop=True)
+            yield chunk
+    finally:
+        # close only what was opened here
+        if istrm is not getattr(src, 'buffer', src):
+            istrm.close()
+
+
+def rowCount(src, compression='infer') -> int:
+    '''
+    the number of rows of a headed CSV file or stream, not counting its
+    header or blank lines
+    '''
+    istrm = opened(src, compression)
+    try:
+        for _ in csvRows(iter(istrm.readline, b''), 1):
+            pass
+        return sum(int(np.count_nonzero(widths))
+                   for _, widths, _ in rowRuns(istrm, 1 << 24))
+    finally:
+        if istrm is not getattr(src, 'buffer', src):
+            istrm.close()
+
+
+def boeBatches(src, fields=('city', 'street', 'st_nbr'), **kwargs):
+    return batches(src, BOE_COLUMNS, fields, **kwargs)
+
+
+def parcelBatches(src, fields=('par_zip', 'gis_st_name', 'st_nbr'), **kwargs):
+    return batches(src, PARCEL_COLUMNS, fields, **kwargs)
+
+
+def _lookup(column, encode):
+    # apply `encode` once per distinct value of a column
+    codes, uniques = pd.factorize(column)
+    table = np.fromiter((encode(u) for u in uniques), dtype=np.int64,
+                        count=len(uniques))
+    return table[codes]
+
+
+def addressKeys(codec: AddressCodec, cities, streets, numbers):
+    '''
+    encode parallel columns of raw city, street and house number strings
+    into the same keys as `codec.rawkey()` would, one at a time
+    '''
+    def number(nr):
+        return codec.number(HALFPATTERN.sub(r'\1.5', nr))
+    codes, uniques = pd.factorize(streets)
+    streets = codec.rawstreets(uniques.tolist())[codes]
+    return ((_lookup(cities, codec.city) << codec.CITY_SHIFT)
+            | (streets << codec.STREET_SHIFT)
+            | _lookup(numbers, number))
+
+
+def registeredKeys(src, codec: AddressCodec, **kwargs):
+    '''
+    keys of the addresses of every row of a BoE registration file or stream,
+    equivalent to encoding `exclusion.registered()`
+    '''
+    keys = [addressKeys(codec, b['city'], b['street'], b['st_nbr'])
+            for b in boeBatches(src, **kwargs)]
+    if not keys:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(keys)
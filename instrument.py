@@ -0,0 +1,180 @@
+import json
+import sys
+from collections import Counter
+from time import perf_counter
+
+
+class Stage(object):
+    '''
+    wall time spent in, and rows passed through, one stage of a pipeline
+    '''
+    __slots__ = ('name', 'seconds', 'rows', 'calls')
+
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.rows = 0
+        self.calls = 0
+
+
+class Timer(object):
+    # context manager timing one entry into a stage; see `Profiler.stage()`
+    __slots__ = ('profiler', 'stage', 'start')
+
+    def __init__(self, profiler, stage):
+        self.profiler = profiler
+        self.stage = stage
+
+    def __enter__(self):
+        self.profiler.frames.append(0.0)
+        self.start = perf_counter()
+        return self.stage
+
+    def __exit__(self, *exc):
+        self.profiler.leave(self.stage, perf_counter() - self.start)
+        return False
+
+
+class Profiler(object):
+    '''
+    per-stage wall times and row counts of a run, along with named counters.
+    Stages may nest, e.g. a generator timed as one stage pulling from another
+    timed as a second; each stage is only charged for time not spent in the
+    stages it calls into, so that stage times add up to the run's.
+    '''
+    enabled = True
+
+    def __init__(self):
+        self.stages = {}
+        self.counters = Counter()
+        # time spent in nested stages, per stage entered but not yet left
+        self.frames = []
+        self.start = perf_counter()
+
+    def _stage(self, name) -> Stage:
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = Stage(name)
+        return stage
+
+    def leave(self, stage: Stage, elapsed: float):
+        stage.seconds += elapsed - self.frames.pop()
+        stage.calls += 1
+        if self.frames:
+            self.frames[-1] += elapsed
+
+    def stage(self, name) -> Timer:
+        '''
+        context manager timing its body as part of the named stage; it
+        evaluates to the `Stage`, so that the body may add to its `rows`
+        '''
+        return Timer(self, self._stage(name))
+
+    def timed(self, name, iterable):
+        '''
+        timed() instantiates a generator of the items of an iterable,
+        counting each as a row of the named stage and timing the work done
+        to produce it as part of that stage
+        '''
+        stage = self._stage(name)
+        items = iter(iterable)
+        frames = self.frames
+        while True:
+            frames.append(0.0)
+            start = perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+            finally:
+                self.leave(stage, perf_counter() - start)
+            stage.rows += 1
+            yield item
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def asdict(self):
+        return {
+            'seconds': perf_counter() - self.start,
+            'stages': [{'name': s.name, 'seconds': s.seconds, 'rows': s.rows,
+                        'calls': s.calls} for s in self.stages.values()],
+            'counters': dict(self.counters),
+        }
+
+    def summary(self) -> str:
+        total = perf_counter() - self.start
+        lines = [f'{"stage":<12} {"seconds":>9} {"share":>6}'
+                 f' {"rows":>10} {"rows/s":>10}']
+        for s in self.stages.values():
+            rate = f'{s.rows / s.seconds:>10.0f}' if s.seconds else ''
+            lines.append(f'{s.name:<12} {s.seconds:>9.3f}'
+                         f' {s.seconds / total:>6.1%} {s.rows:>10} {rate}')
+        other = total - sum(s.seconds for s in self.stages.values())
+        lines.append(f'{"(other)":<12} {other:>9.3f} {other / total:>6.1%}')
+        lines.append(f'{"total":<12} {total:>9.3f}')
+        if self.counters:
+            lines.append('')
+            width = max(map(len, self.counters))
+            for name, n in self.counters.items():
+                lines.append(f'{name:<{width}} {n:>10}')
+        return '\n'.join(lines)
+
+    def dump(self, path):
+        '''
+        print the summary table to stderr if `path` is '-', otherwise write
+        the profile to `path` as JSON
+        '''
+        if path == '-':
+            print(self.summary(), file=sys.stderr)
+            return
+        with open(path, 'w') as ostrm:
+            json.dump(self.asdict(), ostrm, indent=2)
+
+
+class NullTimer(object):
+    __slots__ = ()
+    stage = Stage('null')
+
+    def __enter__(self):
+        return self.stage
+
+    def __exit__(self, *exc):
+        return False
+
+
+class NullProfiler(object):
+    '''
+    stands in for a `Profiler` when profiling is off, doing as little as
+    possible; in particular, `timed()` hands its iterable straight back
+    '''
+    enabled = False
+    timer = NullTimer()
+
+    def stage(self, name):
+        return self.timer
+
+    def timed(self, name, iterable):
+        return iterable
+
+    def count(self, name, n=1):
+        pass
+
+
+# the profiler of the running process; read it through the module, as in
+# `instrument.profiler`, since `enable()` replaces it
+profiler = NullProfiler()
+
+
+def enable() -> Profiler:
+    global profiler
+    profiler = Profiler()
+    return profiler
+
+
+def add_argument(parser):
+    parser.add_argument('--profile', nargs='?', const='-', default=None,
+                        metavar='PATH',
+                        help=('if present, report wall time and rows per'
+                              ' stage, along with various counters, to'
+                              ' stderr, or as JSON to PATH if given'))
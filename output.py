@@ -0,0 +1,286 @@
+import csv
+import gzip
+import io
+import itertools as it
+import os
+import re
+import sys
+from collections import OrderedDict
+from operator import attrgetter
+from common import MonroeCtRecord, canon
+
+# output formats, by the file extension each is written with
+FORMATS = {
+    'csv': '.csv',
+    'csv.gz': '.csv.gz',
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+}
+# positions of the fields `common.canon()` formats into CANON
+FIELDS = MonroeCtRecord.__slots__
+NR, ST, CITY = (FIELDS.index(f) for f in ('st_nbr', 'gis_st_name', 'city'))
+
+
+def tabulated(records, batch=1 << 12):
+    '''
+    tabulated() instantiates a generator of lists of the rows `tuple()`
+    gives of the given records, a batch at a time. Fields are gathered
+    column by column, straight from the columns of a `RecordStore` if the
+    records are its views, and CANON is formatted from those columns by
+    the same `common.canon()` each record's `__str__()` calls.
+    '''
+    getter = attrgetter(*FIELDS)
+    records = iter(records)
+    while True:
+        chunk = list(it.islice(records, batch))
+        if not chunk:
+            return
+        store = getattr(chunk[0], 'store', None)
+        if store is not None and all(r.__class__ is store.view
+                                     for r in chunk):
+            columns = store.take(chunk, FIELDS)
+        else:
+            columns = list(zip(*map(getter, chunk)))
+        yield list(zip(*columns, map(canon, columns[NR], columns[ST],
+                                     columns[CITY])))
+
+
+def batched(rows, batch=1 << 12):
+    '''
+    batched() instantiates a generator of lists of up to `batch` of the
+    given rows
+    '''
+    rows = iter(rows)
+    while True:
+        chunk = list(it.islice(rows, batch))
+        if not chunk:
+            return
+        yield chunk
+
+
+class CSVWriter(object):
+    '''
+    writes batches of rows to a CSV file, gzipped if `compress`, or to
+    stdout if no path is given; if `append`, to the end of an existing file
+    already headed by `header`
+    '''
+    def __init__(self, path, header, compress=False, append=False):
+        self.path = path
+        mode = 'ab' if append else 'wb'
+        if compress:
+            self.raw = sys.stdout.buffer if path is None else open(path, mode)
+            # appending to a gzipped file adds a member to it, which gzip
+            # readers decompress as if it were part of the first
+            self.gz = gzip.GzipFile(fileobj=self.raw, mode='wb',
+                                    compresslevel=6)
+            self.ostrm = io.TextIOWrapper(self.gz, encoding='utf-8',
+                                          newline='')
+        else:
+            self.raw = self.gz = None
+            self.ostrm = (sys.stdout if path is None else
+                          open(path, mode[0], newline=''))
+        self.stenographer = csv.writer(self.ostrm)
+        if not append:
+            self.stenographer.writerow(header)
+
+    def write(self, rows):
+        self.stenographer.writerows(rows)
+
+    def close(self):
+        if self.gz is None:
+            if self.path is None:
+                self.ostrm.flush()
+            else:
+                self.ostrm.close()
+            return
+        # closing the gzip stream writes its trailer, but leaves the file
+        # it writes to open
+        self.ostrm.close()
+        if self.path is not None:
+            self.raw.close()
+
+
+class ArrowWriter(object):
+    '''
+    writes batches of rows to a Parquet file, or to an Arrow IPC file if not
+    `parquet`, as string columns named after the header; rows are buffered
+    into row groups of up to `group` rows
+    '''
+    def __init__(self, path, header, parquet=True, group=1 << 16):
+        import pyarrow as pa
+        self.pa = pa
+        self.schema = pa.schema([(name, pa.string()) for name in header])
+        if parquet:
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(path, self.schema)
+        else:
+            import pyarrow.ipc
+            self.writer = pyarrow.ipc.new_file(path, self.schema)
+        self.group = group
+        self.rows = []
+
+    def write(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.group:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        pa = self.pa
+        columns = zip(*self.rows)
+        self.writer.write_table(pa.Table.from_arrays(
+            [pa.array(c, pa.string()) for c in columns], schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def filename(value: str) -> str:
+    'a file name for a value of the column output is split by'
+    return re.sub(r'[^\w.-]+', '_', value.strip()).strip('.') or '_'
+
+
+class SplitWriter(object):
+    '''
+    writes batches of rows to one file per distinct value of the given
+    column, in a directory. Values that make for the same file name share a
+    file. Only `max_open` CSV files are kept open at a time, the least
+    recently written to of them being closed to make way for another and
+    reopened to append to it later. Parquet and Arrow files can't be
+    appended to, so their rows are kept in memory instead, spilling to
+    temporary CSV files once there are more than `buffered` of them, and
+    written out one file at a time on `close()`.
+    '''
+    def __init__(self, directory, header, format, column, max_open=64,
+                 buffered=1 << 20):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.header = header
+        self.format = format
+        self.key = header.index(column)
+        self.max_open = max_open
+        self.buffered = buffered
+        # open CSV writers, least recently written to first
+        self.writers = OrderedDict()
+        # names of every file written to so far, in order of their first rows
+        self.names = {}
+        # rows of Parquet and Arrow files not yet spilled, and their count
+        self.rows = {}
+        self.nrows = 0
+
+    def path(self, name) -> str:
+        return os.path.join(self.directory, name + FORMATS[self.format])
+
+    def spool(self, name) -> str:
+        return os.path.join(self.directory, f'.{name}.spool.csv')
+
+    def write(self, rows):
+        groups = {}
+        for row in rows:
+            groups.setdefault(filename(row[self.key]), []).append(row)
+        for name, group in groups.items():
+            if self.format in ('parquet', 'arrow'):
+                if name not in self.names:
+                    self.names[name] = None
+                    # left behind by an earlier run that didn't finish
+                    if os.path.exists(self.spool(name)):
+                        os.remove(self.spool(name))
+                self.rows.setdefault(name, []).extend(group)
+                self.nrows += len(group)
+                continue
+            writer = self.writers.pop(name, None)
+            if writer is None:
+                if len(self.writers) >= self.max_open:
+                    _, lru = self.writers.popitem(last=False)
+                    lru.close()
+                writer = CSVWriter(self.path(name), self.header,
+                                   compress=self.format == 'csv.gz',
+                                   append=name in self.names)
+                self.names[name] = None
+            self.writers[name] = writer
+            writer.write(group)
+        if self.nrows > self.buffered:
+            self.spill()
+
+    def spill(self):
+        'append the rows buffered for Parquet and Arrow files to their spools'
+        for name, rows in self.rows.items():
+            with open(self.spool(name), 'a', newline='') as ostrm:
+                csv.writer(ostrm).writerows(rows)
+        self.rows = {}
+        self.nrows = 0
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+        self.writers.clear()
+        if self.format not in ('parquet', 'arrow'):
+            return
+        for name in self.names:
+            writer = open_writer(self.path(name), self.header, self.format)
+            spool = self.spool(name)
+            if os.path.exists(spool):
+                with open(spool, newline='') as istrm:
+                    for rows in batched(csv.reader(istrm), 1 << 16):
+                        writer.write(rows)
+                os.remove(spool)
+            writer.write(self.rows.pop(name, ()))
+            writer.close()
+        self.nrows = 0
+
+
+def open_writer(path, header, format='csv', split=None):
+    '''
+    open_writer() opens a writer of batches of rows under the given header
+    in the given format, to `path`, or to stdout if it's None. Given a
+    `split` column, `path` is instead a directory to write one file per
+    distinct value of that column to; see `SplitWriter`.
+    '''
+    header = list(header)
+    if split is not None:
+        return SplitWriter(path, header, format, named(header, split))
+    if format in ('parquet', 'arrow'):
+        return ArrowWriter(path, header, parquet=format == 'parquet')
+    return CSVWriter(path, header, compress=format == 'csv.gz')
+
+
+def named(header, name) -> str:
+    'the column of the header named `name`, ignoring case'
+    for h in header:
+        if h.lower() == name.lower():
+            return h
+    raise ValueError(f'no column named {name!r} to split output by')
+
+
+def add_arguments(parser):
+    parser.add_argument('--format',
+                        help=('output format; parquet and arrow require'
+                              ' pyarrow'),
+                        choices=tuple(FORMATS),
+                        default='csv')
+    parser.add_argument('--split-by',
+                        metavar='COLUMN',
+                        help=('if given, write one file per distinct value'
+                              ' of this output column, e.g. PAR_ZIP or'
+                              ' P_NAME, to the directory --opath'),
+                        default=None)
+
+
+def check_arguments(parser, args):
+    '''
+    report usage errors in the arguments `add_arguments()` adds, given the
+    output path `args.opath`
+    '''
+    if args.opath is None:
+        if args.split_by is not None:
+            parser.error('--split-by requires --opath')
+        if args.format in ('parquet', 'arrow'):
+            parser.error(f'--format {args.format} requires --opath')
+    if args.format in ('parquet', 'arrow'):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            parser.error(f'--format {args.format} requires pyarrow')
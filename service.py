@@ -0,0 +1,339 @@
+import csv
+import io
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from urllib.parse import parse_qs, urlsplit
+import numpy as np
+import pandas as pd
+from common import StreetAddress
+from addrindex import RegisteredIndex, changed, fingerprint, open_index
+from store import CategoricalColumn, parcelStore, storeRecords
+from exclusion import vexclusion
+from fuzzy import MIN_CONFIDENCE, NearMatcher
+import ingest
+import output
+
+# query parameters parcels can be selected by, along with the field each
+# reads and how its values are compared
+FILTERS = {
+    'zip': ('par_zip', str.strip),
+    'street': ('gis_st_name', StreetAddress.normalize),
+    'precinct': ('p_name', lambda s: s.strip().casefold()),
+}
+
+
+def grouped(column, key) -> dict:
+    '''
+    grouped() maps `key(value)` for each distinct value of a `RecordStore`
+    column to the sorted rows holding a value with that key
+    '''
+    if isinstance(column, CategoricalColumn):
+        codes, labels = column.codes, column.labels
+    else:
+        codes, labels = pd.factorize([column[i] for i in range(len(column))])
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(labels) + 1))
+    groups = {}
+    for k, label in enumerate(labels):
+        rows = order[bounds[k]:bounds[k+1]]
+        name = key(label)
+        if name in groups:
+            rows = np.union1d(groups[name], rows)
+        groups[name] = rows
+    return groups
+
+
+def latest(path):
+    '''
+    the most recently modified file in a directory of snapshots, or `path`
+    itself if it's a file
+    '''
+    if not os.path.isdir(path):
+        return path
+    snapshots = [e for e in os.scandir(path)
+                 if e.is_file() and not e.name.startswith('.')
+                 and not e.name.endswith('.tmp')]
+    if not snapshots:
+        raise FileNotFoundError(f'{path}: no snapshots')
+    return max(snapshots, key=lambda e: e.stat().st_mtime).path
+
+
+class Universe(object):
+    '''
+    a parcel roll held in memory as a `RecordStore`, along with the rows of
+    each ZIP code, street and polling place, so that the parcels a query
+    selects can be found without scanning the roll
+    '''
+    def __init__(self, path):
+        self.store = parcelStore(path)
+        self.header = ingest.header(path) + ['CANON']
+        self.source = fingerprint(path)
+        self.groups = {name: grouped(self.store.columns[field], key)
+                       for name, (field, key) in FILTERS.items()}
+
+    def __len__(self):
+        return len(self.store)
+
+    def select(self, query: dict) -> np.ndarray:
+        '''
+        sorted rows matching a query, which maps names of `FILTERS` to lists
+        of values: rows must match one of the values given for each filter
+        '''
+        rows = np.arange(len(self.store))
+        for name, values in query.items():
+            _, key = FILTERS[name]
+            groups = self.groups[name]
+            hits = [groups.get(key(v)) for v in values]
+            hits = [h for h in hits if h is not None]
+            if not hits:
+                return np.empty(0, dtype=np.int64)
+            rows = np.intersect1d(rows, np.unique(np.concatenate(hits)),
+                                  assume_unique=True)
+        return rows
+
+
+class ExclusionService(object):
+    '''
+    answers exclusion queries against a parcel universe and registered
+    address index loaded once, reloading either when its file changes.
+    `registered` may be a directory of BoE snapshots, in which case the most
+    recent one is used. Queries only look parcels up in the registered
+    index, so any number run at once; only near-miss matching, with
+    `distance`, takes turns on the matcher's lock. Reloads are built aside
+    and swapped in, queries under way finishing against the snapshot they
+    started with.
+    '''
+    def __init__(self, universe, registered, index=None, unrollp=False,
+                 unroll_max=-1, distance=0, settle=2.0,
+                 confidence=MIN_CONFIDENCE):
+        self.paths = {'universe': universe, 'registered': registered}
+        self.index = index
+        self.unrollp = unrollp
+        self.unroll_max = unroll_max
+        self.distance = distance
+        self.confidence = confidence
+        # files modified more recently than this many seconds ago may still
+        # be being written
+        self.settle = settle
+        self.lock = threading.Lock()
+        self.universe = Universe(universe)
+        self.registered = self.loadRegistered(latest(registered))
+        self.matcher = self.nearMatcher(self.registered)
+        self.loaded = {'universe': time.time(), 'registered': time.time()}
+
+    def loadRegistered(self, path) -> RegisteredIndex:
+        if self.index is not None:
+            return open_index(self.index, path)
+        return RegisteredIndex.fromcsv(path)
+
+    def nearMatcher(self, registered: RegisteredIndex):
+        'the matcher of near-miss street names queries share, if any'
+        if self.distance > 0:
+            return NearMatcher(registered, self.distance, self.confidence)
+        return None
+
+    def settled(self, path) -> bool:
+        return time.time() - os.stat(path).st_mtime >= self.settle
+
+    def refresh(self) -> list:
+        '''
+        reload the universe and registered index if their files changed
+        since they were loaded, returning the names of those reloaded
+        '''
+        reloaded = []
+        path = self.paths['universe']
+        if changed(self.universe.source, path) and self.settled(path):
+            universe = Universe(path)
+            with self.lock:
+                self.universe = universe
+                self.loaded['universe'] = time.time()
+            reloaded.append('universe')
+        path = latest(self.paths['registered'])
+        source = self.registered.source
+        moved = source is None or source['path'] != os.path.abspath(path)
+        if (moved or changed(source, path)) and self.settled(path):
+            registered = self.loadRegistered(path)
+            matcher = self.nearMatcher(registered)
+            with self.lock:
+                self.registered = registered
+                self.matcher = matcher
+                self.loaded['registered'] = time.time()
+            reloaded.append('registered')
+        return reloaded
+
+    def watch(self, interval: float, stop: threading.Event):
+        '''
+        call `refresh()` every `interval` seconds until `stop` is set
+        '''
+        while not stop.wait(interval):
+            try:
+                for name in self.refresh():
+                    print(f'reloaded {name}: {self.paths[name]}', flush=True)
+            except Exception as e:
+                # keep serving the last good snapshot
+                print(f'reload failed: {e!r}', flush=True)
+
+    def query(self, query: dict):
+        '''
+        the header of the parcels selected by a query, see
+        `Universe.select()`, whose addresses aren't registered, and a
+        generator of batches of their rows, computed as they're consumed
+        '''
+        with self.lock:
+            universe = self.universe
+            registered = self.registered
+            matcher = self.matcher
+            rows = universe.select(query)
+        X = vexclusion(storeRecords(universe.store, rows), registered,
+                       self.unrollp, self.unroll_max, matcher=matcher)
+        return universe.header, output.tabulated(X)
+
+    def status(self) -> dict:
+        with self.lock:
+            return {
+                'universe': {**self.universe.source,
+                             'parcels': len(self.universe),
+                             'loaded': self.loaded['universe']},
+                'registered': {**(self.registered.source or {}),
+                               'addresses': len(self.registered),
+                               'loaded': self.loaded['registered']},
+            }
+
+
+class Handler(BaseHTTPRequestHandler):
+    '''
+    GET /exclusion?zip=...&street=...&precinct=... streams the unregistered
+    parcels a query selects as CSV; each filter may be repeated to match any
+    of several values. GET /status describes the loaded snapshots as JSON.
+    '''
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'local'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/status':
+            body = json.dumps(self.server.service.status()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if url.path != '/exclusion':
+            self.send_error(404)
+            return
+        query = parse_qs(url.query)
+        unknown = set(query) - set(FILTERS)
+        if unknown:
+            self.send_error(400, f'unknown filters: {", ".join(unknown)}')
+            return
+        start = time.perf_counter()
+        header, batches = self.server.service.query(query)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv; charset=utf-8')
+        self.end_headers()
+        ostrm = io.TextIOWrapper(self.wfile, encoding='utf-8', newline='')
+        stenographer = csv.writer(ostrm)
+        stenographer.writerow(header)
+        n = 0
+        for rows in batches:
+            stenographer.writerows(rows)
+            ostrm.flush()
+            n += len(rows)
+        ostrm.detach()
+        self.log_message('%d rows in %.1f ms', n,
+                         1000 * (time.perf_counter() - start))
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser('serve mailing lists of unregistered voters from'
+                            ' address sets kept in memory')
+    parser.add_argument('--universe',
+                        help='path from which to read universal address set',
+                        required=True)
+    parser.add_argument('--registered',
+                        help=('path from which to read registrant address'
+                              ' set, or of a directory of BoE snapshots, of'
+                              ' which the most recent is used'),
+                        required=True)
+    parser.add_argument('--registered-index',
+                        help=('path of a registered address index to keep'
+                              ' up to date with --registered, so that'
+                              ' restarts needn\'t parse it again'),
+                        default=None)
+    parser.add_argument('--unroll',
+                        help='if present, only unroll address ranges',
+                        action='store_true')
+    parser.add_argument('--unrollmax',
+                        type=int,
+                        help=('max. number of addresses to unroll per range;'
+                              ' longer ranges are truncated to their ends'
+                              ' (default: no limit)'),
+                        default=-1)
+    parser.add_argument('--fuzzy',
+                        type=int,
+                        help=('max. edit distance between the street names'
+                              ' of a parcel and a registered address for the'
+                              ' parcel to count as registered; see'
+                              ' exclusion.py (default: exact matches only)'),
+                        default=0)
+    parser.add_argument('--fuzzy-confidence',
+                        type=float,
+                        help=('min. confidence of a match by --fuzzy; see'
+                              f' exclusion.py (default: {MIN_CONFIDENCE})'),
+                        default=MIN_CONFIDENCE)
+    parser.add_argument('--host',
+                        help='address on which to listen',
+                        default='127.0.0.1')
+    parser.add_argument('--port',
+                        type=int,
+                        help='port on which to listen',
+                        default=8080)
+    parser.add_argument('--socket',
+                        help=('path of a Unix socket on which to listen'
+                              ' instead of --host and --port'),
+                        default=None)
+    parser.add_argument('--poll',
+                        type=float,
+                        help=('seconds between checks of --universe and'
+                              ' --registered for new snapshots'),
+                        default=5.0)
+    args = parser.parse_args()
+    service = ExclusionService(args.universe, args.registered,
+                               args.registered_index, args.unroll,
+                               args.unrollmax, args.fuzzy,
+                               confidence=args.fuzzy_confidence)
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, Handler)
+        where = args.socket
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), Handler)
+        where = f'http://{args.host}:{server.server_port}'
+    server.service = service
+    stop = threading.Event()
+    watcher = threading.Thread(target=service.watch, args=(args.poll, stop),
+                               daemon=True)
+    watcher.start()
+    print(f'{len(service.universe)} parcels, {len(service.registered)}'
+          f' registered addresses; listening on {where}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        if args.socket is not None:
+            os.remove(args.socket)
@@ -0,0 +1,280 @@
+import numpy as np
+import pandas as pd
+from common import HALFPATTERN, MonroeCtRecord, ParcelMixin, ranged
+from ingest import BOE_COLUMNS, PARCEL_COLUMNS, batches
+
+# fields with few enough distinct values to store as codes into a dictionary
+PARCEL_CATEGORIES = ('gis_st_name', 'rps_st_name', 'loc_pre_dir',
+                     'loc_st_name', 'loc_st_type', 'prop_desc', 'sch_name',
+                     'par_zcty', 'par_zip', 'city', 'fe_type', 'p_name',
+                     'pol_address')
+BOE_CATEGORIES = ('city', 'zip', 'party', 'electionDistrict')
+# characters `common.RANGEDELIM` splits house number ranges on
+RANGECHARS = b'-&/'
+
+
+class StringColumn(object):
+    '''
+    strings stored back to back in one UTF-8 buffer, delimited by an array
+    of offsets
+    '''
+    def __init__(self, buf: bytes, offsets: np.ndarray):
+        self.buf = buf
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, chunks):
+        bufs = []
+        lengths = []
+        for chunk in chunks:
+            values = chunk.tolist()
+            text = ''.join(values)
+            buf = text.encode('utf-8')
+            if len(buf) == len(text):
+                # all ASCII, so lengths in characters are lengths in bytes
+                n = map(len, values)
+            else:
+                n = (len(v.encode('utf-8')) for v in values)
+            bufs.append(buf)
+            lengths.append(np.fromiter(n, dtype=np.int64, count=len(values)))
+        offsets = np.zeros(sum(map(len, lengths)) + 1, dtype=np.int64)
+        if len(offsets) > 1:
+            np.cumsum(np.concatenate(lengths), out=offsets[1:])
+        return cls(b''.join(bufs), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.buf[self.offsets[i]:self.offsets[i+1]].decode('utf-8')
+
+    def take(self, rows: np.ndarray) -> list:
+        'the strings at the given rows'
+        buf = self.buf
+        starts = self.offsets[rows].tolist()
+        ends = self.offsets[rows + 1].tolist()
+        return [buf[a:b].decode('utf-8') for a, b in zip(starts, ends)]
+
+    def select(self, rows: np.ndarray) -> 'StringColumn':
+        'column of only the strings at the given rows, in the given order'
+        starts = self.offsets[rows]
+        lengths = self.offsets[rows + 1] - starts
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # position in this buffer of each byte of the selected strings
+        src = (np.repeat(starts - offsets[:-1], lengths)
+               + np.arange(offsets[-1]))
+        buf = np.frombuffer(self.buf, dtype=np.uint8)[src].tobytes()
+        return self.__class__(buf, offsets)
+
+    def contains(self, chars: bytes) -> np.ndarray:
+        '''
+        boolean mask of the strings containing any of the given ASCII chars
+        '''
+        buf = np.frombuffer(self.buf, dtype=np.uint8)
+        hits = np.flatnonzero(np.isin(buf, np.frombuffer(chars, np.uint8)))
+        mask = np.zeros(len(self), dtype=bool)
+        mask[np.searchsorted(self.offsets, hits, side='right') - 1] = True
+        return mask
+
+    def nbytes(self):
+        return len(self.buf) + self.offsets.nbytes
+
+
+class CategoricalColumn(object):
+    '''
+    strings stored as codes into a dictionary of their distinct values
+    '''
+    def __init__(self, codes: np.ndarray, labels: list):
+        self.codes = codes
+        self.labels = labels
+
+    @classmethod
+    def build(cls, chunks):
+        index = {}
+        codes = []
+        for chunk in chunks:
+            local, uniques = pd.factorize(chunk)
+            remap = np.fromiter((index.setdefault(u, len(index))
+                                 for u in uniques), dtype=np.int32,
+                                count=len(uniques))
+            codes.append(remap[local])
+        codes = np.concatenate(codes) if codes else np.empty(0, np.int32)
+        return cls(codes, list(index))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, i):
+        return self.labels[self.codes[i]]
+
+    def take(self, rows: np.ndarray) -> list:
+        'the strings at the given rows'
+        labels = np.empty(len(self.labels), dtype=object)
+        labels[:] = self.labels
+        return labels[self.codes[rows]].tolist()
+
+    def select(self, rows: np.ndarray) -> 'CategoricalColumn':
+        'column of only the strings at the given rows, in the given order'
+        return self.__class__(self.codes[rows], self.labels)
+
+    def nbytes(self):
+        return self.codes.nbytes + sum(len(k) for k in self.labels)
+
+
+class Field(object):
+    '''
+    descriptor reading one column of a `RecordStore` through its views
+    '''
+    __slots__ = ('name', 'column')
+
+    def __init__(self, name, column):
+        self.name = name
+        self.column = column
+
+    def __get__(self, view, owner=None):
+        if view is None:
+            return self
+        if view.overrides is not None and self.name in view.overrides:
+            return view.overrides[self.name]
+        return self.column[view.row]
+
+
+class RecordView(object):
+    '''
+    a row of a `RecordStore`, read through the same attributes as the record
+    class it stands in for; derived views replace some fields and share the
+    rest with their row
+    '''
+    __slots__ = ('store', 'row', 'overrides')
+
+    def __init__(self, store, row, overrides=None):
+        self.store = store
+        self.row = row
+        self.overrides = overrides
+
+    def derive(self, **fields):
+        'view of the same row with the given fields replaced'
+        if self.overrides is not None:
+            fields = {**self.overrides, **fields}
+        return self.__class__(self.store, self.row, fields)
+
+
+class ParcelView(ParcelMixin, RecordView):
+    '''
+    a parcel of a `RecordStore`, standing in for a `MonroeCtRecord`
+    '''
+    __slots__ = ()
+
+
+class RecordStore(object):
+    '''
+    column-oriented table of records, with one contiguous buffer per field
+    instead of one object per row, read back through `RecordView`s
+    '''
+    def __init__(self, columns: dict, view=RecordView):
+        self.columns = columns
+        self.fields = tuple(columns)
+        # give each store its own view class, reading its columns directly
+        fields = {f: Field(f, c) for f, c in columns.items()}
+        self.view = type(view.__name__, (view,), {'__slots__': (), **fields})
+        # byte offsets of the rows in the file they were read from, if kept
+        self.offsets = None
+
+    @classmethod
+    def load(cls, src, columns, fields, categories=(), view=RecordView,
+             transforms={}, offsets=False, **kwargs):
+        '''
+        read the given fields of a CSV file or stream through
+        `ingest.batches()`, applying any `transforms` to their batches;
+        given `offsets`, keep the byte offset of each row as well
+        '''
+        chunks = {f: [] for f in fields}
+        starts = []
+        for batch in batches(src, columns, fields, offsets=offsets,
+                             **kwargs):
+            for f in fields:
+                chunk = batch[f]
+                if f in transforms:
+                    chunk = transforms[f](chunk)
+                chunks[f].append(chunk)
+            if offsets:
+                starts.append(batch['offset'].to_numpy(dtype=np.int64))
+        store = cls({f: (CategoricalColumn if f in categories else
+                         StringColumn).build(chunks[f]) for f in fields},
+                    view)
+        if offsets:
+            store.offsets = (np.concatenate(starts) if starts else
+                             np.empty(0, dtype=np.int64))
+        return store
+
+    def __len__(self):
+        return len(self.columns[self.fields[0]]) if self.fields else 0
+
+    def __getitem__(self, i):
+        return self.view(self, i)
+
+    def __iter__(self):
+        view = self.view
+        for i in range(len(self)):
+            yield view(self, i)
+
+    def take(self, views, fields) -> list:
+        '''
+        the values of the given fields of a batch of this store's views,
+        column by column, read straight from the store's columns rather than
+        through each view in turn
+        '''
+        rows = np.fromiter((v.row for v in views), dtype=np.int64,
+                           count=len(views))
+        columns = [self.columns[f].take(rows) for f in fields]
+        positions = {f: k for k, f in enumerate(fields)}
+        for i, v in enumerate(views):
+            if v.overrides is not None:
+                for f, x in v.overrides.items():
+                    if f in positions:
+                        columns[positions[f]][i] = x
+        return columns
+
+    def nbytes(self):
+        return sum(c.nbytes() for c in self.columns.values())
+
+
+def parcelStore(src, fields=MonroeCtRecord.__slots__,
+                **kwargs) -> RecordStore:
+    '''
+    load the given fields of a parcel roll into a `RecordStore` of
+    `ParcelView`s; like `MonroeCtRecord`, house numbers of the form '5 1/2'
+    are read as '5.5'
+    '''
+    def halves(column):
+        mask = column.str.contains(' ', regex=False)
+        if mask.any():
+            column = column.copy()
+            column[mask] = column[mask].str.replace(HALFPATTERN, r'\1.5',
+                                                    regex=True)
+        return column
+    return RecordStore.load(src, PARCEL_COLUMNS, fields, PARCEL_CATEGORIES,
+                            ParcelView, {'st_nbr': halves}, **kwargs)
+
+
+def boeStore(src, fields=tuple(BOE_COLUMNS), **kwargs) -> RecordStore:
+    return RecordStore.load(src, BOE_COLUMNS, fields, BOE_CATEGORIES,
+                            **kwargs)
+
+
+def storeRecords(store: RecordStore, rows=None):
+    '''
+    storeRecords() instantiates a generator of the parcels of a store like
+    `common.addressRecords()` does of a parcel roll, minus the header; given
+    an array of `rows`, only of those, in the given order
+    '''
+    # only parse house numbers that might be ranges
+    maybe = store.columns['st_nbr'].contains(RANGECHARS)
+    view = store.view
+    rows = range(len(store)) if rows is None else rows.tolist()
+    for i in rows:
+        if maybe[i]:
+            yield ranged(view(store, i))
+        else:
+            yield view(store, i)
@@ -0,0 +1,63 @@
+import csv
+import gzip
+import random
+import pandas as pd
+import pytest
+from deltaroll import BoEIndices, stratify, stratifyStream
+
+PARTIES = ('DEM', 'REP', 'BLK', 'IND', 'CON')
+WIDTH = 39
+
+
+def write(path, rows):
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'wt', newline='') as ostrm:
+        stenographer = csv.writer(ostrm)
+        for row in rows:
+            if row is None:
+                ostrm.write('\n')
+            else:
+                stenographer.writerow(row)
+
+
+def snapshots(directory, suffix='.csv', voters=600, seed=0):
+    '''
+    write two headless registration snapshots of mostly the same voters,
+    with churn between them, voters listed more than once (the last row of
+    each counts), and stray short rows and blank lines
+    '''
+    rnd = random.Random(seed)
+    parties = {v: rnd.choice(PARTIES) for v in range(voters)}
+    paths = []
+    for k in range(2):
+        rows = []
+        for v in range(voters):
+            if rnd.random() < 0.05:
+                continue
+            if rnd.random() < 0.03:
+                parties[v] = rnd.choice(PARTIES)
+            for _ in range(1 + (rnd.random() < 0.05)):
+                row = [''] * WIDTH
+                row[BoEIndices.vid] = f'NY{v:06d}'
+                row[BoEIndices.party] = rnd.choice(PARTIES)
+                row[BoEIndices.electionDistrict] = str(rnd.randrange(4))
+                rows.append(row)
+            if rnd.random() < 0.02:
+                rows.append([f'NY{v:06d}', 'short'])
+            if rnd.random() < 0.02:
+                rows.append(None)
+        rnd.shuffle(rows)
+        paths.append(directory / f'snapshot{k}{suffix}')
+        write(paths[-1], rows)
+    return paths
+
+
+@pytest.mark.parametrize('suffix', ('.csv', '.csv.gz'))
+@pytest.mark.parametrize('groups', ((), (BoEIndices.electionDistrict,)))
+def test_stream_matches_stratify(tmp_path, suffix, groups):
+    old, new = snapshots(tmp_path, suffix)
+    expected = stratify(old, new, groups=groups)
+    for max_memory in (1 << 12, 256 << 20):
+        table = stratifyStream(old, new, groups=groups,
+                               max_memory=max_memory)
+        pd.testing.assert_frame_equal(table, expected, check_dtype=False)
@@ -0,0 +1,116 @@
+import csv
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import pytest
+from addrindex import RegisteredIndex
+from bench import synthesize
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def run(*args):
+    'run the exclusion CLI with the given arguments'
+    subprocess.run([sys.executable, os.path.join(HERE, 'exclusion.py'),
+                    *map(str, args)], check=True, cwd=HERE)
+
+
+def rows(path):
+    with open(path, newline='') as istrm:
+        return list(csv.reader(istrm))
+
+
+@pytest.fixture(scope='module')
+def paths(tmp_path_factory):
+    return synthesize(str(tmp_path_factory.mktemp('data')), 2000)
+
+
+def test_previous_with_compressed_universe(paths, tmp_path):
+    universe = tmp_path / 'universe.csv.gz'
+    with open(paths['universe'], 'rb') as istrm, \
+            gzip.open(universe, 'wb') as ostrm:
+        shutil.copyfileobj(istrm, ostrm)
+    first, full, patched = (tmp_path / f'{k}.csv'
+                            for k in ('first', 'full', 'patched'))
+    run('--universe', universe, '--registered', paths['old'], '--opath',
+        first)
+    run('--universe', universe, '--registered', paths['new'], '--opath',
+        full)
+    run('--universe', universe, '--registered', paths['new'],
+        '--previous', first, '--previous-registered', paths['old'],
+        '--opath', patched)
+    assert rows(patched) == rows(full)
+    assert rows(patched) != rows(first)
+
+
+@pytest.mark.parametrize('options', ((), ('--unroll',), ('--unrollmax', 4)))
+@pytest.mark.parametrize('indexed', (False, True))
+def test_previous_matches_full_run(paths, tmp_path, options, indexed):
+    first, full, patched = (tmp_path / f'{k}.csv'
+                            for k in ('first', 'full', 'patched'))
+    run('--universe', paths['universe'], '--registered', paths['old'],
+        '--opath', first, *options)
+    run('--universe', paths['universe'], '--registered', paths['new'],
+        '--opath', full, *options)
+    previous = paths['old']
+    indices = ()
+    if indexed:
+        # both registrations from saved indices, the universe from its own
+        previous = str(tmp_path / 'old.idx')
+        RegisteredIndex.fromcsv(paths['old']).save(previous)
+        indices = ('--registered-index', tmp_path / 'new.idx',
+                   '--universe-index', tmp_path / 'universe.idx')
+    run('--universe', paths['universe'], '--registered', paths['new'],
+        '--previous', first, '--previous-registered', previous,
+        '--opath', patched, *indices, *options)
+    assert rows(patched) == rows(full)
+    assert rows(patched) != rows(first)
+
+
+def test_workers_match_single_process(paths, tmp_path):
+    single, sharded = tmp_path / 'single.csv', tmp_path / 'sharded.csv'
+    run('--universe', paths['universe'], '--registered', paths['old'],
+        '--opath', single)
+    run('--universe', paths['universe'], '--registered', paths['old'],
+        '--opath', sharded, '--workers', 3)
+    assert rows(sharded) == rows(single)
+
+
+def test_generator_reads_compressed(paths, tmp_path):
+    universe, registered = (tmp_path / f'{k}.csv.gz'
+                            for k in ('universe', 'old'))
+    for src, dst in ((paths['universe'], universe), (paths['old'],
+                                                      registered)):
+        with open(src, 'rb') as istrm, gzip.open(dst, 'wb') as ostrm:
+            shutil.copyfileobj(istrm, ostrm)
+    vectorized, generated = (tmp_path / f'{k}.csv'
+                             for k in ('vectorized', 'generated'))
+    run('--universe', paths['universe'], '--registered', paths['old'],
+        '--opath', vectorized)
+    run('--universe', universe, '--registered', registered, '--opath',
+        generated, '--engine', 'generator')
+    assert rows(generated) == rows(vectorized)
+
+
+@pytest.mark.parametrize('options', ((), ('--engine', 'generator'),
+                                     ('--workers', 2)))
+def test_implausible_ranges_keep_their_ends(paths, tmp_path, options):
+    universe, excluded = tmp_path / 'universe.csv', tmp_path / 'out.csv'
+    parcels = rows(paths['universe'])
+    for i, nr in enumerate(('1-99999', '2-1e9', '10-16', '1-inf')):
+        row = list(parcels[1])
+        row[0], row[2], row[3] = f'R{i}', nr, 'Nowhere Rd'
+        parcels.append(row)
+    with open(universe, 'w', newline='') as ostrm:
+        csv.writer(ostrm).writerows(parcels)
+    run('--universe', universe, '--registered', paths['old'], '--opath',
+        excluded, *options)
+    numbers = {}
+    for row in rows(excluded)[1:]:
+        numbers.setdefault(row[0], []).append(row[2])
+    assert numbers['R0'] == ['1', '99999']
+    assert numbers['R1'] == ['2', '1000000000']
+    assert numbers['R2'] == ['10', '12', '14', '16']
+    assert numbers['R3'] == ['1-inf']
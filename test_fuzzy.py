@@ -0,0 +1,36 @@
+from common import StreetAddress
+from addrindex import RegisteredIndex
+from fuzzy import NearMatcher, levenshtein
+
+REGISTERED = [('14610', 'Oak Ln', '16'), ('14610', 'Harold Cir', '9'),
+              ('14610', 'Park St', '9'), ('14610', 'Edgewood Ave', '30')]
+
+
+def nearest(parcels, distance=2, **kwargs):
+    index = RegisteredIndex.build(StreetAddress(*a) for a in REGISTERED)
+    matcher = NearMatcher(index, distance, **kwargs)
+    keys = index.codec.encode(StreetAddress(*a) for a in parcels)
+    return [m and m[0] for m in matcher.nearest(keys)]
+
+
+def test_levenshtein():
+    assert levenshtein('herald cir', 'harold cir', 3) == 2
+    assert levenshtein('kitten', 'sitting', 3) == 3
+    assert levenshtein('kitten', 'sitting', 2) == 3
+
+
+def test_nearest_within_block():
+    parcels = [('14610', 'Herald Cir', '9'), ('14610', 'Edgwood Ave', '30'),
+               # another house number, or city, is another block
+               ('14610', 'Edgwood Ave', '32'), ('14618', 'Edgwood Ave', '30'),
+               # a different designator is a different street
+               ('14610', 'Park Ct', '9')]
+    assert nearest(parcels) == ['harold cir', 'edgewood ave', None, None, None]
+
+
+def test_nearest_requires_confidence():
+    # 'bay ln' is two edits from 'oak ln', a confidence of only 2/3
+    parcels = [('14610', 'Bay Ln', '16'), ('14610', 'Herald Cir', '9')]
+    assert nearest(parcels) == [None, 'harold cir']
+    assert nearest(parcels, confidence=0) == ['oak ln', 'harold cir']
+    assert nearest(parcels, confidence=0.9) == [None, None]
@@ -0,0 +1,177 @@
+import asyncio
+import json
+from aiohttp import web
+from common import StreetAddress
+from geocode import ResultCache, validate
+
+MATCH = json.dumps({'Response': {'View': [{'Result': [
+    {'MatchLevel': 'houseNumber', 'Relevance': 1}]}]}})
+NO_MATCH = json.dumps({'Response': {'View': [{'Result': [
+    {'MatchLevel': 'street', 'Relevance': 0.8}]}]}})
+
+
+class Parcel(object):
+    'the parts of a parcel record `validate()` reads'
+    def __init__(self, nr, st='Main St', city='Rochester'):
+        self.st_nbr = nr
+        self.gis_st_name = st
+        self.city = city
+
+    def address(self) -> StreetAddress:
+        return StreetAddress(self.city, self.gis_st_name, self.st_nbr)
+
+    def __str__(self):
+        return f'{self.st_nbr} {self.gis_st_name}, {self.city}, NY, USA'
+
+
+class Stub(object):
+    '''
+    stand-in for the HERE geocoder: even house numbers match, odd ones
+    don't. Answers to earlier requests take longer, so that they finish
+    out of order, and addresses listed in `flaky` are first turned away
+    with each of the given statuses, along with a Retry-After. The first
+    `stalls` attempts at addresses listed in `stalled` hang for a second.
+    '''
+    def __init__(self, flaky=(), statuses=(429, 503), retry_after='0.1',
+                 stalled=(), stalls=1):
+        self.flaky = set(flaky)
+        self.stalled = set(stalled)
+        self.stalls = stalls
+        self.statuses = statuses
+        self.retry_after = retry_after
+        self.requests = []
+        self.answered = []
+        self.attempts = {}
+        self.inflight = 0
+        self.peak = 0
+
+    async def geocode(self, request):
+        text = request.query['searchtext']
+        loop = asyncio.get_running_loop()
+        self.requests.append((text, loop.time()))
+        self.inflight += 1
+        self.peak = max(self.peak, self.inflight)
+        try:
+            await asyncio.sleep(max(0.05 - 0.002 * len(self.requests), 0))
+            attempt = self.attempts[text] = self.attempts.get(text, 0) + 1
+            if text in self.stalled and attempt <= self.stalls:
+                await asyncio.sleep(1.0)
+            if text in self.flaky and attempt <= len(self.statuses):
+                return web.Response(status=self.statuses[attempt - 1],
+                                    headers={'Retry-After':
+                                             self.retry_after})
+            nr = int(text.split()[0])
+            return web.Response(text=MATCH if nr % 2 == 0 else NO_MATCH,
+                                content_type='application/json')
+        finally:
+            self.inflight -= 1
+            self.answered.append(text)
+
+    async def run(self, universe, **kwargs):
+        'the results of validating the universe against this stub'
+        app = web.Application()
+        app.router.add_get('/geocode.json', self.geocode)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        try:
+            return [(ent, ok) async for ent, ok in validate(
+                universe, 'id', 'key',
+                endpoint=f'http://{host}:{port}/geocode.json', **kwargs)]
+        finally:
+            await runner.cleanup()
+
+
+def test_validate_in_input_order():
+    stub = Stub()
+    universe = [Parcel(str(nr)) for nr in range(1, 41)]
+    results = asyncio.run(stub.run(universe, concurrency=4))
+    assert [ent for ent, _ in results] == universe
+    assert [ok for _, ok in results] == [nr % 2 == 0
+                                         for nr in range(1, 41)]
+    # answers came back out of order, yet were yielded in input order
+    assert stub.answered != [str(ent) for ent in universe]
+    assert sorted(stub.answered) == sorted(map(str, universe))
+
+
+def test_validate_bounds_concurrency():
+    stub = Stub()
+    universe = [Parcel(str(nr)) for nr in range(1, 41)]
+    asyncio.run(stub.run(universe, concurrency=4))
+    assert stub.peak == 4
+
+
+def test_validate_queries_duplicates_once():
+    stub = Stub()
+    universe = [Parcel(str(nr)) for nr in (2, 3, 2, 2, 3)]
+    results = asyncio.run(stub.run(universe))
+    assert [ok for _, ok in results] == [True, False, True, True, False]
+    assert len(stub.requests) == 2
+
+
+def test_validate_retries_after_429_and_503():
+    universe = [Parcel(str(nr)) for nr in range(1, 9)]
+    flaky = {str(universe[2]), str(universe[5])}
+    stub = Stub(flaky=flaky)
+    # a backoff far longer than Retry-After, in case it's ignored
+    results = asyncio.run(stub.run(universe, backoff=5.0))
+    assert [ok for _, ok in results] == [nr % 2 == 0 for nr in range(1, 9)]
+    for text in flaky:
+        times = [t for q, t in stub.requests if q == text]
+        assert len(times) == 3
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        assert all(0.1 <= gap < 2.0 for gap in gaps)
+    assert len(stub.requests) == len(universe) + 2 * len(flaky)
+
+
+def test_validate_gives_up_on_other_errors():
+    universe = [Parcel('2')]
+    stub = Stub(flaky={str(universe[0])}, statuses=(403,))
+    try:
+        asyncio.run(stub.run(universe))
+    except ValueError as e:
+        assert '403' in str(e)
+    else:
+        raise AssertionError('403 was retried or ignored')
+    assert len(stub.requests) == 1
+
+
+def test_validate_retries_timeouts():
+    universe = [Parcel(str(nr)) for nr in range(1, 5)]
+    stalled = str(universe[1])
+    stub = Stub(stalled={stalled})
+    results = asyncio.run(stub.run(universe, timeout=0.25, backoff=0.01))
+    assert [ok for _, ok in results] == [nr % 2 == 0 for nr in range(1, 5)]
+    assert [q for q, _ in stub.requests].count(stalled) == 2
+
+
+def test_validate_gives_up_after_timeouts():
+    universe = [Parcel('2')]
+    stub = Stub(stalled={str(universe[0])}, stalls=3)
+    try:
+        asyncio.run(stub.run(universe, timeout=0.1, retries=2,
+                             backoff=0.01))
+    except asyncio.TimeoutError:
+        pass
+    else:
+        raise AssertionError('the timeouts were ignored')
+    assert len(stub.requests) == 3
+
+
+def test_validate_from_cache(tmp_path):
+    universe = [Parcel(str(nr)) for nr in range(1, 21)]
+    path = str(tmp_path / 'results.db')
+    stub = Stub()
+    cache = ResultCache(path)
+    first = asyncio.run(stub.run(universe, cache=cache))
+    cache.close()
+    assert len(stub.requests) == 20
+    stub = Stub()
+    cache = ResultCache(path)
+    second = asyncio.run(stub.run(universe, cache=cache))
+    cache.close()
+    assert second == first
+    assert stub.requests == []
+    assert (cache.hits, cache.misses) == (20, 0)
@@ -0,0 +1,64 @@
+import csv
+import gzip
+import io
+import random
+import pandas as pd
+import pytest
+import ingest
+
+COLUMNS = {i: i for i in range(6)}
+FIELDS = [0, 2, 5]
+
+
+def text(quoted, seed=0):
+    '''
+    headless CSV text of rows of all widths, with blank lines, CRLF line
+    breaks, and, if `quoted`, quoted fields holding commas and line breaks
+    '''
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(1000):
+        r = rnd.random()
+        if r < 0.05:
+            lines.append(rnd.choice(('\n', '\r\n')))
+            continue
+        fields = [str(rnd.randrange(1000)) if rnd.random() < 0.8 else ''
+                  for _ in range(rnd.choice((1, 2, 5, 6, 6, 6, 7)))]
+        if quoted and rnd.random() < 0.1:
+            fields[0] = '"a,\nb"'
+        lines.append(','.join(fields) + rnd.choice(('\n',) * 9 + ('\r\n',)))
+    return ''.join(lines).rstrip('\n')
+
+
+@pytest.mark.parametrize('quoted', (False, True))
+@pytest.mark.parametrize('blocksize', (16, 1000, 1 << 20))
+def test_batches_match_csv(quoted, blocksize):
+    data = text(quoted).encode('utf-8')
+    chunks = list(ingest.batches(io.BytesIO(data), COLUMNS, FIELDS,
+                                 blocksize=blocksize, offsets=True,
+                                 header=False))
+    got = pd.concat(chunks, ignore_index=True)
+    rows = [row for row in csv.reader(io.StringIO(data.decode('utf-8')))
+            if len(row) >= 6]
+    assert got[FIELDS].values.tolist() == [[row[f] for f in FIELDS]
+                                           for row in rows]
+    # each row starts at its offset
+    for offset, row in zip(got['offset'].tolist(), rows):
+        line = data[offset:offset+100].decode('utf-8')
+        assert next(csv.reader(io.StringIO(line))) == row
+
+
+def test_batches_decompress(tmp_path):
+    data = text(True).encode('utf-8')
+    path = tmp_path / 'rows.csv.gz'
+    with gzip.open(path, 'wb') as ostrm:
+        ostrm.write(data)
+    plain = list(ingest.batches(io.BytesIO(data), COLUMNS, FIELDS,
+                                offsets=True, header=False))
+    compressed = list(ingest.batches(str(path), COLUMNS, FIELDS,
+                                     offsets=True, header=False))
+    pd.testing.assert_frame_equal(pd.concat(compressed, ignore_index=True),
+                                  pd.concat(plain, ignore_index=True))
+    assert ingest.rowCount(str(path)) == ingest.rowCount(io.BytesIO(data)) \
+        == sum(1 for row in csv.reader(io.StringIO(data.decode('utf-8')))
+               if row) - 1
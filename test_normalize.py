@@ -0,0 +1,91 @@
+import itertools as it
+import random
+import pytest
+from common import AddressCodec, StreetAddress, StreetNormalizer
+
+NAMES = ('Herald', 'Lake Shore', 'Mt Hope', 'St Paul', 'Avenue D', 'Park')
+DIRECTIONS = ('', 'N', 'north', 'SE', 'Southwest', 'w')
+QUALIFIERS = ('', 'Circle', 'cir', 'AVENUE', 'av', 'Street', 'st', 'Blvd')
+
+
+def corpus():
+    '''
+    street names mixing directions before and after the name, qualifiers
+    spelled out and abbreviated, and stray case and whitespace, each
+    repeated so that some are looked up again after being evicted
+    '''
+    streets = []
+    for name, pre, post, qual in it.product(NAMES, DIRECTIONS, DIRECTIONS,
+                                            QUALIFIERS):
+        streets.append(' '.join(t for t in (pre, name, qual, post) if t))
+    streets += [f'  {s.upper()} ' for s in streets[::7]]
+    streets *= 3
+    random.Random(0).shuffle(streets)
+    return streets
+
+
+def test_normalize_matches_canonicalize():
+    normalizer = StreetNormalizer(maxsize=16)
+    streets = corpus()
+    for street in streets:
+        assert normalizer.normalize(street) == \
+            StreetAddress.canonicalize(street)
+        assert len(normalizer.cache) <= 16
+    assert normalizer.hits + normalizer.misses == len(streets)
+    # far more misses than distinct spellings, so entries were evicted
+    assert normalizer.misses > len(set(streets))
+
+
+def test_normalize_many_matches_canonicalize():
+    normalizer = StreetNormalizer(maxsize=16)
+    streets = corpus()
+    canon = normalizer.normalize_many(streets)
+    assert canon == [StreetAddress.canonicalize(s) for s in streets]
+    # a second pass, through evicted entries, gives the same forms
+    assert normalizer.normalize_many(streets) == canon
+    assert normalizer.hits + normalizer.misses == 2 * len(streets)
+    assert len(normalizer.cache) <= 16
+
+
+def test_codec_shares_normalizer():
+    codec = AddressCodec()
+    normalizer = StreetAddress.normalizer
+    hits = normalizer.hits
+    streets = ['N Herald Circle', 'herald cir north', 'Park Ave', 'park av']
+    ids = codec.rawstreets(streets).tolist()
+    assert ids == [codec.rawstreet(s) for s in streets] == [0, 0, 1, 1]
+    assert list(codec.streets) == [StreetAddress.canonicalize(s)
+                                   for s in streets[::2]]
+    # the second round of lookups was answered by the normalizer's cache
+    assert normalizer.hits - hits >= len(streets)
+
+
+def test_codec_refuses_overflow():
+    codec = AddressCodec()
+    codec.CITY_LIMIT = codec.STREET_LIMIT = codec.NUMBER_LIMIT = 2
+    assert [codec.city(c) for c in ('14604', '14605', '14604')] == [0, 1, 0]
+    with pytest.raises(OverflowError):
+        codec.city('14606')
+    codec.street('park ave')
+    codec.street('lake st')
+    with pytest.raises(OverflowError):
+        codec.street('oak st')
+    # canonical house numbers need no id; only the others fill up
+    assert codec.number('12') == 24
+    codec.number('12A')
+    codec.number('12B')
+    with pytest.raises(OverflowError):
+        codec.number('12C')
+    assert codec.number('12B') == codec.NUMBER_SPLIT + 1
+    assert len(codec.cities) == len(codec.streets) == len(codec.numbers) == 2
+
+
+def test_normalize_interns():
+    normalizer = StreetNormalizer(maxsize=2)
+    a = normalizer.normalize('N Herald Circle')
+    normalizer.normalize('Park Ave')
+    normalizer.normalize('Lake St')
+    b = normalizer.normalize('n herald cir')
+    # evicted and canonicalized again, but still the same string
+    assert a == StreetAddress.canonicalize('N Herald Circle')
+    assert a is b